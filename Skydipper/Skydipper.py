@@ -1,8 +1,7 @@
-import requests
-import random
+from .transport import transport
 import json
-from .utils import html_box, nested_set
-from .user import User
+from .utils import html_box, load_batch, update_payload
+from .user import get_user
 
 class Metadata:
     """
@@ -19,7 +18,7 @@ class Metadata:
         self.id = attributes.get('id')
         self.server = server
         self.type = "Metadata"
-        self.User = User()
+        self.User = get_user()
         self.attributes = attributes.get('attributes')
 
     def __repr__(self):
@@ -53,7 +52,7 @@ class Metadata:
             try:
                 url = f'{self.server}/v1/dataset/{ds_id}/metadata'
                 print('url',url)
-                r = requests.patch(url, data=json.dumps(payload), headers=self.User.headers)
+                r = transport.patch(url, data=json.dumps(payload), headers=self.User.headers)
             except:
                 raise ValueError(f'Metadata update failed.')
             if r.status_code == 200:
@@ -78,7 +77,7 @@ class Metadata:
         if lang and app:
             try:
                 url = f'{self.server}/dataset/{ds_id}/metadata?application={app}&language={lang}'
-                r = requests.delete(url, headers=self.User.headers)
+                r = transport.delete(url, headers=self.User.headers)
             except:
                 raise ValueError(f'Metdata deletion failed.')
             if r.status_code == 200:
@@ -136,7 +135,7 @@ class Vocabulary:
             try:
                 url = f'{self.server}/dataset/{ds_id}/vocabulary/{vocab_type}?app={app}'
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-                r = requests.delete(url, headers=headers)
+                r = transport.delete(url, headers=headers)
             except:
                 raise ValueError(f'Vocabulary deletion failed.')
             if r.status_code == 200:
@@ -152,6 +151,9 @@ class Widget:
     attributes: dic
         A dictionary holding the attributes of a widget (which are attached to a Dataset).
     """
+    # Attributes that can be sent in an update
+    update_keys = ["widgetConfig", "name", "description", "application", "default", "protected", "defaultEditableWidget", "published", "freeze"]
+
     def __init__(self, id_hash=None, attributes=None, server="https://api.skydipper.com"):
         self.id = id_hash
         self.server = server
@@ -164,6 +166,26 @@ class Widget:
         else:
             raise ValueError(f'Unable to initialise Widget without id_hash.')
 
+    @classmethod
+    def from_payload(cls, payload, server="https://api.skydipper.com"):
+        """
+        Build a Widget from a widget document returned by the API, e.g. one embedded in a dataset's includes,
+        without requesting it again.
+        """
+        widget = cls.__new__(cls)
+        widget.id = payload.get('id')
+        widget.server = server
+        widget.attributes = payload.get('attributes')
+        return widget
+
+    @classmethod
+    def from_ids(cls, ids, server="https://api.skydipper.com", workers=16):
+        """
+        Load many widgets at once with bounded parallel requests, returning a BatchResult in the order
+        of `ids`. Ids that fail are None in the result, with their error in `result.errors`.
+        """
+        return load_batch(ids, lambda i: cls(id_hash=i, server=server), workers=workers)
+
     def __repr__(self):
         return self.__str__()
 
@@ -178,9 +200,8 @@ class Widget:
         Returns a widget from a Vizzuality API.
         """
         try:
-            hash = random.getrandbits(16)
-            url = (f'{self.server}/v1/widget/{self.id}?hash={hash}')
-            r = requests.get(url)
+            url = f'{self.server}/v1/widget/{self.id}'
+            r = transport.get(url)
         except:
             raise ValueError(f'Unable to get Widget {self.id} from {r.url}')
 
@@ -196,35 +217,31 @@ class Widget:
         A single application string must be specified within the
         `update_params` dictionary, as well as an (optional) widgetCOnfig dictionary.
 
-        Note, widgetConfig has a free schema.
+        Note, widgetConfig has a free schema. Only the top-level attributes that change are sent,
+        updates changing nothing are skipped, and the widget is refreshed from the PATCH response.
         """
         from .dataset import Dataset
         if not token:
             raise ValueError(f'[token] API token required to update widget.')
         ds_id = self.attributes.get('dataset', None)
         w_id = self.id
-        update_keys = ["widgetConfig", "name", "description", "application", "default", "protected", "defaultEditableWidget", "published", "freeze"]
+        update_keys = self.update_keys
         attributes = {f'{k}':v for k,v in self.attributes.items() if k in update_keys}
-        if update_params and any([x in update_keys for x in list(update_params.keys())]):
-            payload = {}
-            for k, v in update_params.items():
-                if '.' in k:
-                    nested_keys = k.split('.')
-                    if len(nested_keys) > 1 and nested_keys[0] in list(attributes.keys()):
-                        payload[nested_keys[0]] = attributes.get(nested_keys[0])
-                        nested_set(payload, nested_keys, v)
-                elif k in list(attributes.keys()):
-                    payload[k] = v
+        if update_params and any([x.split('.')[0] in update_keys for x in list(update_params.keys())]):
+            payload = update_payload(attributes, update_params, list(attributes.keys()))
+            if not payload:
+                print('Nothing to update.')
+                return self
             try:
                 url = f'{self.server}/v1/dataset/{ds_id}/widget/{w_id}'
-                print('url',url)
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'}
-                r = requests.patch(url, data=json.dumps(payload), headers=headers)
+                r = transport.patch(url, data=json.dumps(payload), headers=headers)
             except:
                 raise ValueError(f'Widget update failed.')
             if r.status_code == 200:
                 print(f'Widget updated.')
-                self.attributes = self.get_widget()
+                response = r.json().get('data') or {}
+                self.attributes = response.get('attributes') or self.get_widget()
                 return self
             else:
                 print(f'Failed with error code {r.status_code}')
@@ -244,7 +261,7 @@ class Widget:
         try:
             url = f'{self.server}/dataset/{ds_id}/widget/{w_id}'
             headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-            r = requests.delete(url, headers=headers)
+            r = transport.delete(url, headers=headers)
         except:
             raise ValueError(f'Widget deletion failed.')
         if r.status_code == 200:
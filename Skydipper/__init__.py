@@ -1,13 +1,35 @@
-from .Skydipper import Vocabulary, Metadata, Widget
-from .layer import Layer
-from .image import Image
-from .user import User
-from .imageCollection import ImageCollection
-from .dataset import Dataset
-from .geometry import Geometry
-from .collection import Collection
-from pkg_resources import get_distribution
-import os
-import requests
-
-__version__ = get_distribution('Skydipper').version
\ No newline at end of file
+import importlib
+
+# Public names and the submodule defining them. Submodules (and the heavy dependencies they pull in,
+# e.g. geopandas, folium, ee) are only imported the first time one of these names is used.
+_lazy_attributes = {
+    'Vocabulary': '.Skydipper',
+    'Metadata': '.Skydipper',
+    'Widget': '.Skydipper',
+    'Layer': '.layer',
+    'Image': '.image',
+    'User': '.user',
+    'get_user': '.user',
+    'ImageCollection': '.imageCollection',
+    'Dataset': '.dataset',
+    'Geometry': '.geometry',
+    'Collection': '.collection',
+}
+
+__all__ = list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name], __name__), name)
+        globals()[name] = value
+        return value
+    if name == '__version__':
+        from importlib.metadata import version
+        globals()['__version__'] = version('Skydipper')
+        return globals()['__version__']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__ + ['__version__'])
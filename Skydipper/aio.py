@@ -0,0 +1,213 @@
+"""
+Asyncio versions of the read paths, e.g.
+
+    datasets = await asyncio.gather(*[AsyncDataset.load(i) for i in ids])
+
+Requests share one pooled `aiohttp.ClientSession` and return the usual Dataset, Layer, Geometry
+and Collection objects. They go through the same per-server rate limits, circuit breakers and
+retry budgets as the synchronous transport. Close the session when done, with `await close()` or
+
+    async with Skydipper.aio.client:
+        ...
+
+Requires aiohttp (`pip install Skydipper[async]`).
+"""
+import time
+import asyncio
+from .transport import transport
+from .user import get_user
+from .utils import dataset_includes
+
+
+class AsyncClient:
+    """
+    Shared asynchronous HTTP client.
+
+    Parameters
+    ----------
+    limit: int
+        Maximum number of simultaneous connections.
+    limit_per_host: int
+        Maximum number of simultaneous connections to one server.
+    timeout: float
+        Total timeout of a request in seconds.
+    """
+    def __init__(self, limit=100, limit_per_host=20, timeout=120):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self._session = None
+        self._loop = None
+
+    def __repr__(self):
+        return f"AsyncClient limit={self.limit} limit_per_host={self.limit_per_host}"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def session(self):
+        """Returns the pooled session of the running event loop, creating it on first use."""
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError('The asyncio API requires aiohttp: pip install Skydipper[async]')
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._loop is not loop:
+            self.discard()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._loop = loop
+        return self._session
+
+    def discard(self):
+        """
+        Close the session of a previous event loop (e.g. of an earlier `asyncio.run`), which can no longer
+        be awaited: its connections are closed without waiting for them.
+        """
+        try:
+            self._session.connector.close()
+        except Exception:
+            pass
+        self._session = None
+
+    async def send_once(self, session, url, params=None, headers=None):
+        """
+        Send a single GET, bounded by the transport's rate and concurrency limits for the server.
+        Returns the response and its decoded JSON body (None unless the status is 200).
+        """
+        with transport.lock:
+            transport.stats['requests'] += 1
+        bucket, limiter = transport.limiters(url)
+        if bucket:
+            wait = bucket.try_acquire()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = bucket.try_acquire()
+        while not limiter.try_acquire():
+            await asyncio.sleep(0.01)
+        start = time.monotonic()
+        try:
+            async with session.get(url, params=params, headers=headers) as r:
+                body = await r.json(content_type=None) if r.status == 200 else None
+        except BaseException:
+            limiter.release(ok=False)
+            raise
+        limiter.release(ok=r.status != 429 and r.status < 500, latency=time.monotonic() - start)
+        authorization = (headers or {}).get('Authorization')
+        if r.status == 401 and authorization:
+            from .user import invalidate_user
+            invalidate_user(token=authorization.split(' ')[-1])
+        return r, body
+
+    async def get(self, url, params=None, headers=None):
+        """
+        GET a url, returning its status code and decoded JSON body (None unless the status is 200).
+        Transient failures are retried with the transport's retry policy, within the endpoint's retry
+        budget and the server's circuit breaker (raising `CircuitOpenError` while it is open).
+        """
+        import aiohttp
+        session = self.session()
+        retry = transport.retry
+        breaker = transport.breaker(url)
+        budget = transport.budget(url)
+        budget.deposit()
+        if breaker:
+            breaker.before(url)
+        attempt = 0
+        while True:
+            r, body, error = None, None, None
+            try:
+                r, body = await self.send_once(session, url, params=params, headers=headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                error = err
+            except BaseException:
+                if breaker:
+                    breaker.release()
+                raise
+            if error is None and (r.status == 200 or not retry or attempt >= retry.retries or r.status not in retry.statuses):
+                break
+            if error is not None and (not retry or attempt >= retry.retries):
+                break
+            delay = retry.delay(attempt, response=r)
+            if delay > retry.max_backoff or not budget.withdraw():
+                break
+            with transport.lock:
+                transport.stats['retries'] += 1
+            await asyncio.sleep(delay)
+            attempt += 1
+        # One outcome per request, once its retries are used up
+        if breaker:
+            breaker.record(ok=error is None and not breaker.is_failure(status=r.status))
+        if error is not None:
+            raise error
+        return r.status, body
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+client = AsyncClient()
+
+
+async def close():
+    """Close the shared session, e.g. when an application shuts down."""
+    await client.close()
+
+
+class AsyncDataset:
+    """Asynchronous loading of Dataset objects."""
+    @staticmethod
+    async def load(id_hash, server="https://api.skydipper.com", token=None):
+        """Returns the Dataset with its layers, widgets, vocabularies and metadata, using a single request."""
+        from .dataset import Dataset
+        url = f'{server}/v1/dataset/{id_hash}?includes={dataset_includes(server)}'
+        status, body = await client.get(url, headers=get_user(token=token).read_headers)
+        if status != 200:
+            raise ValueError(f'Dataset with id={id_hash} does not exist.')
+        return Dataset.from_payload(body.get('data'), server=server, token=token)
+
+
+class AsyncLayer:
+    """Asynchronous loading of Layer objects."""
+    @staticmethod
+    async def load(id_hash, server="https://api.skydipper.com", mapbox_token=None, token=None):
+        from .layer import Layer
+        url = f'{server}/v1/layer/{id_hash}?includes=metadata'
+        status, body = await client.get(url, headers=get_user(token=token).read_headers)
+        if status != 200:
+            raise ValueError(f'Layer with id={id_hash} does not exist for server={server}.')
+        return Layer.from_payload(body.get('data'), server=server, mapbox_token=mapbox_token, token=token)
+
+
+class AsyncGeometry:
+    """Asynchronous loading of Geometry objects."""
+    @staticmethod
+    async def get(id_hash, simplify=False, version='v2', server='https://api.skydipper.com', token=None):
+        from .geometry import Geometry
+        url = f'{server}/{version}/geostore/{id_hash}?simplify={simplify}'
+        status, body = await client.get(url, headers=get_user(token=token).read_headers)
+        if status != 200:
+            raise ValueError(f'Unable to get geometry {id_hash} from {url}')
+        return Geometry.from_payload({'id': id_hash, **body.get('data')}, server=server, token=token)
+
+
+class AsyncCollection:
+    """Asynchronous search of Collection objects."""
+    @staticmethod
+    async def search(**kwargs):
+        """Returns a Collection; accepts the same keyword arguments as `Collection`."""
+        from .collection import Collection
+        collection = Collection(**kwargs, metadata=[])
+        url = f"{collection.server}/v1/search"
+        status, body = await client.get(url, params=collection.payload, headers=collection.User.read_headers)
+        response_list = (body or {}).get('data', None)
+        if not response_list:
+            raise ValueError('No items found')
+        collection.metadata = response_list
+        return collection
@@ -0,0 +1,437 @@
+from .transport import transport
+import os
+import json
+import gzip
+import time
+import hashlib
+import importlib.util
+import datetime
+import threading
+from .utils import parallel_map, dataset_includes
+from .user import get_user
+
+
+def today():
+    """
+    The current day (YYYY-MM-DD), naming the default backup destinations: running the same
+    backup again that day resumes it instead of starting a new one.
+    """
+    return datetime.date.today().isoformat()
+
+
+def record_hash(record):
+    """The sha256 hash of the canonical JSON of a record, identical for identical records."""
+    return hashlib.sha256(BlobStore.canonical(record)).hexdigest()
+
+
+def fetch_record(ds_id, server="https://api.skydipper.com", user=None):
+    """Returns the backup record of a dataset: its config with the embedded layers, metadata etc."""
+    user = user or get_user()
+    url = f"{server}/v1/dataset/{ds_id}?includes={dataset_includes(server)}"
+    r = transport.get(url, headers=user.read_headers)
+    if r.status_code != 200:
+        raise ValueError(f'Could not retrieve config of {ds_id}: {r.status_code}.')
+    return {
+        "id": ds_id,
+        "type": "dataset",
+        "server": server,
+        "attributes": r.json()['data']['attributes']
+    }
+
+
+def backup_path(path=None):
+    """
+    Returns the folder to save a backup to, creating it if needed. By default a date-referenced
+    folder in ./LMI-BACKUP.
+    """
+    if not path:
+        path = './LMI-BACKUP'
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        path += f'/{today()}'
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+class BlobStore:
+    """
+    Content-addressed, deduplicating store of backup records.
+
+    Each record is stored once, under the sha256 hash of its canonical JSON, in `{root}/blobs`
+    (zstd compressed if the `zstandard` package is installed, gzip otherwise). A snapshot is a small
+    manifest of id: hash in `{root}/snapshots/{name}.json`, so saving unchanged records again costs
+    no space and restoring a record from any date is a lookup.
+
+    Parameters
+    ----------
+    root: str
+        Folder of the store.
+    compression: str
+        'zstd' (falling back to 'gzip' if zstandard is not installed), 'gzip' or None.
+    """
+    def __init__(self, root='./LMI-BACKUP/store', compression='zstd'):
+        self.root = root
+        if compression == 'zstd' and not importlib.util.find_spec('zstandard'):
+            compression = 'gzip'
+        self.compression = compression
+        for folder in [f"{root}/blobs", f"{root}/snapshots"]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    def __repr__(self):
+        return f"BlobStore {self.root} {len(self.snapshots())} snapshots"
+
+    @staticmethod
+    def canonical(record):
+        """The canonical JSON encoding of a record: sorted keys, no whitespace."""
+        return json.dumps(record, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode()
+
+    def blob(self, digest):
+        """Returns the path of an existing blob, or None."""
+        for extension in ['zst', 'gz', 'json']:
+            path = f"{self.root}/blobs/{digest[:2]}/{digest}.{extension}"
+            if os.path.exists(path):
+                return path
+        return None
+
+    def put(self, record):
+        """Store a record unless an identical one is already stored, returning its hash."""
+        data = self.canonical(record)
+        digest = record_hash(record)
+        if self.blob(digest):
+            return digest
+        if self.compression == 'zstd':
+            import zstandard
+            data, extension = zstandard.ZstdCompressor().compress(data), 'zst'
+        elif self.compression == 'gzip':
+            data, extension = gzip.compress(data), 'gz'
+        else:
+            extension = 'json'
+        folder = f"{self.root}/blobs/{digest[:2]}"
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        tmp_file = f"{folder}/{digest}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, f"{folder}/{digest}.{extension}")
+        return digest
+
+    def get(self, digest):
+        """Returns the record stored under a hash."""
+        path = self.blob(digest)
+        if not path:
+            raise ValueError(f'Blob {digest} not found in {self.root}')
+        with open(path, 'rb') as f:
+            data = f.read()
+        if path.endswith('.zst'):
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif path.endswith('.gz'):
+            data = gzip.decompress(data)
+        return json.loads(data)
+
+    def snapshots(self):
+        """Names of the snapshots in the store, oldest first."""
+        return sorted(name[:-len('.json')] for name in os.listdir(f"{self.root}/snapshots") if name.endswith('.json'))
+
+    def write_snapshot(self, name, entries, server=None):
+        """Write the manifest (id: hash) of a snapshot."""
+        manifest = {'name': name, 'server': server, 'created': datetime.datetime.utcnow().isoformat(), 'entries': entries}
+        tmp_file = f"{self.root}/snapshots/{name}.json.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, f"{self.root}/snapshots/{name}.json")
+
+    def read_snapshot(self, name=None):
+        """
+        Returns the manifest of a snapshot. `name` may be a prefix such as a date ('2020-05-01'), matching the
+        latest snapshot of that day; by default the latest snapshot.
+        """
+        names = [n for n in self.snapshots() if n.startswith(name or '')]
+        if not names:
+            raise ValueError(f'No snapshot {name or ""} in {self.root}')
+        with open(f"{self.root}/snapshots/{names[-1]}.json") as f:
+            return json.load(f)
+
+    def load(self, ds_id, snapshot=None):
+        """Returns the record of a dataset as saved in a snapshot (default latest)."""
+        entries = self.read_snapshot(snapshot)['entries']
+        if ds_id not in entries:
+            raise ValueError(f'Dataset {ds_id} not in snapshot {snapshot or "latest"} of {self.root}')
+        return self.get(entries[ds_id])
+
+
+class Archive:
+    """
+    Single-file backup in compressed JSON Lines: every record is appended as its own gzip member, so the
+    archive is written incrementally with bounded memory and reads as plain JSONL with any gzip tool.
+    A `{path}.index` file of `id offset length` lines gives random access to each record.
+
+    Parameters
+    ----------
+    path: str
+        Path of the archive, e.g. './LMI-BACKUP/2020-05-01.jsonl.gz'.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_file = f"{path}.index"
+        self.lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def __repr__(self):
+        return f"Archive {self.path}"
+
+    def __iter__(self):
+        """Stream every record in the order it was written."""
+        with gzip.open(self.path, 'rt') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def index(self):
+        """Returns a dictionary of id: (offset, length) of the latest record written for each id."""
+        if not os.path.exists(self.index_file):
+            return {}
+        index = {}
+        with open(self.index_file) as f:
+            for line in f:
+                entry = line.split()
+                if len(entry) == 3:
+                    index[entry[0]] = (int(entry[1]), int(entry[2]))
+        return index
+
+    def repair(self):
+        """Truncate the archive after its last indexed record, dropping a record left half written by an interrupted run."""
+        if not os.path.exists(self.path):
+            return
+        end = max([offset + length for offset, length in self.index().values()], default=0)
+        if os.path.getsize(self.path) > end:
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+    def append(self, record):
+        """Compress and append a record, then index it."""
+        data = gzip.compress((json.dumps(record) + '\n').encode(), compresslevel=6)
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+            with open(self.index_file, 'a') as f:
+                f.write(f"{record['id']} {offset} {len(data)}\n")
+
+    def get(self, ds_id, index=None):
+        """Read a single record, seeking straight to it with the index."""
+        index = index or self.index()
+        if ds_id not in index:
+            raise ValueError(f'Dataset {ds_id} not in archive {self.path}')
+        offset, length = index[ds_id]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(gzip.decompress(f.read(length)))
+
+    def remove(self):
+        for path in [self.path, self.index_file]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class BackupReader:
+    """
+    Read access to any backup: a folder of `{id}.json` files, an Archive, or a snapshot
+    (default the latest) of a BlobStore.
+    """
+    def __init__(self, path, snapshot=None):
+        self.path = path
+        if os.path.isfile(path) and os.path.exists(f"{path}.index"):
+            self.format = 'archive'
+            self.archive = Archive(path)
+            self.index = self.archive.index()
+        elif os.path.isdir(f"{path}/snapshots"):
+            self.format = 'store'
+            self.store = BlobStore(path)
+            self.entries = self.store.read_snapshot(snapshot)['entries']
+        else:
+            self.format = 'files'
+
+    def __repr__(self):
+        return f"BackupReader {self.format} {self.path}"
+
+    def ids(self):
+        """Ids of the datasets in the backup."""
+        if self.format == 'archive':
+            return list(self.index)
+        if self.format == 'store':
+            return list(self.entries)
+        return sorted(name[:-len('.json')] for name in os.listdir(self.path) if name.endswith('.json'))
+
+    def get(self, ds_id):
+        """Returns the record of a dataset."""
+        if self.format == 'archive':
+            return self.archive.get(ds_id, index=self.index)
+        if self.format == 'store':
+            if ds_id not in self.entries:
+                raise ValueError(f'Dataset {ds_id} not in snapshot of {self.path}')
+            return self.store.get(self.entries[ds_id])
+        with open(f"{self.path}/{ds_id}.json") as f:
+            return json.load(f)
+
+    def digest(self, ds_id):
+        """Returns the `record_hash` of a dataset's record; read from the manifest, without loading it, for a store."""
+        if self.format == 'store' and ds_id in self.entries:
+            return self.entries[ds_id]
+        return record_hash(self.get(ds_id))
+
+
+def read_record(path, ds_id, snapshot=None):
+    """
+    Read the record of a dataset back from a backup: a folder of `{id}.json` files, an Archive,
+    or a BlobStore (at `snapshot`, by default the latest).
+    """
+    return BackupReader(path, snapshot=snapshot).get(ds_id)
+
+
+class Backup:
+    """
+    Backup engine: saves dataset configs (with their layers, metadata etc.) locally, as one `{id}.json`
+    file per dataset (format='files'), as a snapshot of a content-addressed BlobStore (format='store'),
+    or to a single compressed JSON Lines Archive (format='archive').
+
+    Datasets are fetched from up to `workers` threads, bounded by the transport's per-server limits.
+    Each saved id is recorded in a checkpoint file, so an interrupted backup to the same path resumes
+    where it left off.
+
+    Parameters
+    ----------
+    path: str
+        Folder to save to. Default ./LMI-BACKUP/<date> for files, ./LMI-BACKUP/store for a store.
+        For an archive, the path of the file, default ./LMI-BACKUP/<date>.jsonl.gz. The date is
+        the current day, so running the same backup again that day resumes it.
+    server: str
+        A URL string of the server to back up from.
+    token: str
+        An (optional) API token.
+    workers: int
+        Maximum number of datasets fetched at once.
+    resume: bool
+        Skip the datasets recorded in the checkpoint file by a previous run. Set to False to save everything again.
+    format: str
+        'files', 'store' or 'archive'.
+    snapshot: str
+        Name of the snapshot written to a store. Default the current day (YYYY-MM-DD), so that running
+        the same backup again that day resumes it.
+    compression: str
+        Compression of the blobs of a store, see `BlobStore`.
+    """
+    def __init__(self, path=None, server="https://api.skydipper.com", token=None, workers=16, resume=True,
+                 format='files', snapshot=None, compression='zstd'):
+        if format not in ['files', 'store', 'archive']:
+            raise ValueError(f"Unknown backup format '{format}', expected 'files', 'store' or 'archive'.")
+        self.format = format
+        self.server = server
+        self.User = get_user(token=token)
+        self.workers = workers
+        if format == 'store':
+            self.store = BlobStore(path or './LMI-BACKUP/store', compression=compression)
+            self.path = self.store.root
+            self.snapshot = snapshot or today()
+            self.checkpoint_file = f"{self.path}/snapshots/{self.snapshot}.checkpoint"
+        elif format == 'archive':
+            # The index of the archive is its checkpoint
+            self.archive = Archive(path or f'./LMI-BACKUP/{today()}.jsonl.gz')
+            self.path = self.archive.path
+            self.checkpoint_file = self.archive.index_file
+            if not resume:
+                self.archive.remove()
+            self.archive.repair()
+        else:
+            self.path = backup_path(path)
+            self.checkpoint_file = f"{self.path}/.checkpoint"
+        self.lock = threading.Lock()
+        if not resume and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        self.stats = {}
+
+    def __repr__(self):
+        return f"Backup {self.path} {self.stats}"
+
+    def completed(self):
+        """Ids already saved by this backup, with the hash of their record in a store (or None)."""
+        if self.format == 'archive':
+            return {ds_id: None for ds_id in self.archive.index()}
+        if not os.path.exists(self.checkpoint_file):
+            return {}
+        with open(self.checkpoint_file) as f:
+            entries = [line.split() for line in f if line.strip()]
+        return {entry[0]: entry[1] if len(entry) > 1 else None for entry in entries}
+
+    def checkpoint(self, ds_id, digest=None):
+        with self.lock:
+            with open(self.checkpoint_file, 'a') as f:
+                f.write(f"{ds_id} {digest}\n" if digest else f"{ds_id}\n")
+
+    def fetch(self, ds_id):
+        """Returns the backup record of a dataset."""
+        return fetch_record(ds_id, server=self.server, user=self.User)
+
+    def write(self, record):
+        """Write a record, returning its hash if it went to a store."""
+        if self.format == 'store':
+            return self.store.put(record)
+        if self.format == 'archive':
+            return self.archive.append(record)
+        with open(f"{self.path}/{record['id']}.json", 'w') as fp:
+            json.dump(record, fp)
+
+    def save(self, ds_id):
+        """Fetch, write and checkpoint a single dataset."""
+        digest = self.write(self.fetch(ds_id))
+        if self.format != 'archive':
+            self.checkpoint(ds_id, digest)
+
+    def write_snapshot(self, merge=False):
+        """
+        Write the manifest of the snapshot from the saved datasets. With `merge`, the datasets of the latest
+        snapshot are kept, and only the saved ones replaced (e.g. when saving a single dataset).
+        """
+        entries = {}
+        if merge and self.store.snapshots():
+            entries = self.store.read_snapshot()['entries']
+        entries.update(self.completed())
+        self.store.write_snapshot(self.snapshot, entries, server=self.server)
+
+    def run(self, ids):
+        """
+        Save every dataset in `ids` (duplicates are saved once), returning the list of ids that failed.
+        Prints a summary of the throughput.
+        """
+        from tqdm import tqdm
+        ids = list(dict.fromkeys(ids))
+        done = self.completed()
+        todo = [i for i in ids if i not in done]
+        progress = tqdm(total=len(todo))
+        start = time.monotonic()
+
+        def save(ds_id):
+            try:
+                self.save(ds_id)
+            finally:
+                progress.update(1)
+
+        results = parallel_map(save, todo, workers=self.workers, return_exceptions=True)
+        progress.close()
+        failed = [i for i, r in zip(todo, results) if isinstance(r, Exception)]
+        if self.format == 'store':
+            self.write_snapshot()
+        elapsed = time.monotonic() - start
+        self.stats = {
+            'saved': len(todo) - len(failed),
+            'skipped': len(ids) - len(todo),
+            'failed': len(failed),
+            'seconds': round(elapsed, 1)
+        }
+        rate = self.stats['saved'] / elapsed if elapsed else 0
+        print(f"Saved {self.stats['saved']} datasets in {elapsed:.1f}s ({rate:.1f}/s), "
+              f"{self.stats['skipped']} already saved, {self.stats['failed']} failed.")
+        return failed
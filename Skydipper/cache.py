@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class ResponseCache:
+    """
+    Opt-in cache of GET responses, revalidated with `If-None-Match` / `If-Modified-Since`.
+
+    Entries are kept in an in-memory LRU and, if a `path` is given, in a size-bounded directory on disk
+    so they survive between processes. Only responses carrying an `ETag` or `Last-Modified` header are stored.
+
+    Parameters
+    ----------
+    path: str
+        Optional folder for the on-disk cache, e.g. '~/.Skydipper/http-cache'.
+    max_entries: int
+        Maximum number of responses kept in memory.
+    max_bytes: int
+        Maximum total size in bytes of the response bodies kept in memory, and of the on-disk cache.
+        Least recently used entries are evicted first; larger responses are not cached.
+    max_age: float
+        Number of seconds a cached response is served without revalidating it. Default 0 (always revalidate).
+    """
+    def __init__(self, path=None, max_entries=1024, max_bytes=256 * 1024 * 1024, max_age=0):
+        self.path = os.path.expanduser(path) if path else None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        if self.path and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def __repr__(self):
+        return f"ResponseCache {len(self.entries)} entries {self.stats}"
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(url, headers=None):
+        """Cache key for a url and the credentials it was requested with."""
+        authorization = (headers or {}).get('Authorization', '')
+        return hashlib.sha256(f"{url} {authorization}".encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached entry (a dictionary) for a key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                return entry
+        entry = self.read(key)
+        if entry:
+            self.remember(key, entry)
+        return entry
+
+    def is_fresh(self, entry):
+        return self.max_age > 0 and time.time() - entry['stored_at'] < self.max_age
+
+    def conditional_headers(self, entry):
+        """Headers that make the server answer 304 if the cached entry is still current."""
+        headers = {}
+        if entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    def store(self, key, r):
+        """Store a 200 response if it can be revalidated later."""
+        if r.status_code != 200 or not (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+            return
+        if 'no-store' in r.headers.get('Cache-Control', ''):
+            return
+        if len(r.content) > self.max_bytes:
+            return
+        entry = {
+            'url': r.url,
+            'status_code': r.status_code,
+            'reason': r.reason,
+            'encoding': r.encoding,
+            'headers': dict(r.headers),
+            'content': r.content,
+            'stored_at': time.time()
+        }
+        self.remember(key, entry)
+        self.write(key, entry)
+
+    def touch(self, key, entry):
+        """Mark an entry as revalidated by a 304 response."""
+        entry['stored_at'] = time.time()
+        if self.path and os.path.exists(self.file(key)):
+            os.utime(self.file(key))
+
+    def remember(self, key, entry):
+        """Keep an entry in memory, evicting the least recently used beyond `max_entries` or `max_bytes`."""
+        if len(entry['content']) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous:
+                self.memory_bytes -= len(previous['content'])
+            self.entries[key] = entry
+            self.memory_bytes += len(entry['content'])
+            while len(self.entries) > self.max_entries or self.memory_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.memory_bytes -= len(evicted['content'])
+
+    def file(self, key):
+        return f"{self.path}/{key}.json"
+
+    def read(self, key):
+        if not self.path or not os.path.exists(self.file(key)):
+            return None
+        try:
+            with open(self.file(key)) as f:
+                entry = json.load(f)
+            entry['content'] = entry['content'].encode('latin-1')
+            os.utime(self.file(key))
+            return entry
+        except:
+            return None
+
+    def write(self, key, entry):
+        if not self.path:
+            return
+        tmp_file = f"{self.file(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({**entry, 'content': entry['content'].decode('latin-1')}, f)
+        os.replace(tmp_file, self.file(key))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the on-disk cache fits in `max_bytes`."""
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                stat = os.stat(f"{self.path}/{name}")
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(f[1] for f in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(f"{self.path}/{name}")
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.memory_bytes = 0
+        if self.path:
+            for name in os.listdir(self.path):
+                if name.endswith('.json'):
+                    os.remove(f"{self.path}/{name}")
+
+    @staticmethod
+    def response(entry):
+        """Rebuild a `requests.Response` from a cached entry."""
+        r = requests.Response()
+        r.status_code = entry['status_code']
+        r.reason = entry['reason']
+        r.url = entry['url']
+        r.encoding = entry['encoding']
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r._content = entry['content']
+        r.from_cache = True
+        return r
+
+
+def write_parquet(frame, path):
+    """
+    Write a query result to a Parquet file: GeoParquet (geometry columns as WKB, with their CRS)
+    if it has a geometry column, plain Parquet otherwise. The file is replaced atomically.
+    """
+    import pandas as pd
+    from .utils import arrow_available
+    arrow_available(True)
+    tmp_file = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        try:
+            frame.geometry
+        except AttributeError:
+            pd.DataFrame(frame).to_parquet(tmp_file)
+        else:
+            frame.to_parquet(tmp_file)
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return path
+
+
+def read_parquet(path):
+    """
+    Open a Parquet file written by `write_parquet` as a GeoDataFrame. The file is memory-mapped
+    rather than read into a buffer first.
+    """
+    import pandas as pd
+    import geopandas as gpd
+    import pyarrow.parquet
+    if b'geo' in (pyarrow.parquet.read_schema(path).metadata or {}):
+        return gpd.read_parquet(path, memory_map=True)
+    return gpd.GeoDataFrame(pd.read_parquet(path, memory_map=True))
+
+
+class QueryCache:
+    """
+    On-disk cache of query results, as (Geo)Parquet files.
+
+    Results are keyed by the dataset id, the SQL sent to the query service (with its whitespace normalised)
+    and the dataset's `updatedAt`, so editing a dataset invalidates its cached queries.
+    Cached results are opened memory-mapped. Requires pyarrow (`pip install Skydipper[arrow]`).
+
+    Parameters
+    ----------
+    path: str
+        Folder of the cache.
+    max_bytes: int
+        Maximum total size in bytes of the cache. Least recently used results are evicted first.
+    max_age: float
+        Number of seconds after which a result that has not been used is evicted. 0 to keep results until evicted by size.
+    """
+    def __init__(self, path='~/.Skydipper/query-cache', max_bytes=2 * 1024 ** 3, max_age=7 * 24 * 3600):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def __repr__(self):
+        return f"QueryCache {self.path} {self.stats}"
+
+    @staticmethod
+    def key(dataset_id, sql, updated_at=None, **options):
+        """Cache key for a query of a dataset at a given `updatedAt`, with options changing its result (e.g. columnar)."""
+        sql = ' '.join(sql.strip().rstrip(';').split())
+        options = json.dumps(options, sort_keys=True)
+        return hashlib.sha256(f"{dataset_id} {updated_at} {sql} {options}".encode()).hexdigest()
+
+    def file(self, key):
+        return f"{self.path}/{key}.parquet"
+
+    def get(self, key):
+        """Returns the cached result for a key (a memory-mapped GeoDataFrame), or None."""
+        path = self.file(key)
+        if not os.path.exists(path) or self.is_expired(os.stat(path).st_mtime):
+            self.stats['misses'] += 1
+            return None
+        try:
+            frame = read_parquet(path)
+        except Exception:
+            self.stats['misses'] += 1
+            return None
+        os.utime(path)
+        self.stats['hits'] += 1
+        return frame
+
+    def put(self, key, frame):
+        """Store a query result, then evict results beyond `max_age` and `max_bytes`."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        write_parquet(frame, self.file(key))
+        self.evict()
+
+    def is_expired(self, last_used):
+        return self.max_age > 0 and time.time() - last_used > self.max_age
+
+    def evict(self):
+        """Remove results unused for `max_age`, then the least recently used until the cache fits in `max_bytes`."""
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.parquet'):
+                stat = os.stat(f"{self.path}/{name}")
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(f[1] for f in files)
+        for last_used, size, name in sorted(files):
+            if total <= self.max_bytes and not self.is_expired(last_used):
+                break
+            try:
+                os.remove(f"{self.path}/{name}")
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith('.parquet'):
+                    os.remove(f"{self.path}/{name}")
+
+
+query_cache = QueryCache()
+
+
+def configure_query_cache(path=None, max_bytes=None, max_age=None):
+    """
+    Update the package-wide query cache used by `Dataset.query_cached`,
+    e.g. `Skydipper.cache.configure_query_cache(max_bytes=10 * 1024 ** 3, max_age=0)`.
+    """
+    if path: query_cache.path = os.path.expanduser(path)
+    if max_bytes is not None: query_cache.max_bytes = max_bytes
+    if max_age is not None: query_cache.max_age = max_age
+    return query_cache
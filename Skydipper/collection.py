@@ -1,13 +1,9 @@
-import requests
+from .transport import transport
 import random
-import os
-import json
-import datetime
-from tqdm import tqdm
 from .dataset import Dataset
 from .layer import Layer
-from .utils import create_class, show, flatten_list, parse_filters
-from .user import User
+from .utils import create_class, show, flatten_list, parse_filters, prefetched, load_batch
+from .user import get_user
 from .Skydipper import Metadata
 
 class Collection:
@@ -42,11 +38,18 @@ class Collection:
     filters: dict
         A dictionary of filter key, value pairs e.g. {'provider', 'gee'}
         Possible search keys: 'connectorType', 'provider', 'status', 'published', 'protected', 'geoInfo'.
+    token: str
+        An (optional) API token.
+    metadata: list
+        Search results already fetched (e.g. by `Skydipper.aio.AsyncCollection.search`). Skips the search request.
+
+    The search is only requested when the results are first needed: iterating over a collection
+    streams them page by page (see `stream`), other uses (indexing, len...) fetch them all into `metadata`.
     """
     def __init__(self, name=None, altname=None, description=None, app=['skydipper','soilsRevealed','test'], env='production', limit=1000, order='name', sort='desc',
                 server="https://api.skydipper.com", language=None, citation=None,
-                 filters=None, mapbox_token=None):
-        self.User = User()
+                 filters=None, mapbox_token=None, token=None, metadata=None):
+        self.User = get_user(token=token)
         # self.search = search
         self.name = name
         self.altname = altname
@@ -63,9 +66,22 @@ class Collection:
         self.mapbox_token = mapbox_token
         self.object_type = ['datasett']
         self.payload = self.get_payload()
-        self.metadata = self.get_metadata()
+        self._metadata = metadata
         #self.collection = self.get_collection()
-        self.iter_position = 0
+
+    @property
+    def metadata(self):
+        """The search results, up to `limit`, requested page by page the first time they are needed."""
+        if self._metadata is None:
+            metadata = list(self.stream(prefetch=0))
+            if not metadata:
+                raise ValueError('No items found')
+            self._metadata = metadata
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, value):
+        self._metadata = value
 
     def _repr_html_(self):
         str_html = ""
@@ -86,22 +102,24 @@ class Collection:
         return rep_string
 
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self.iter_position >= len(self.metadata):
-            self.iter_position = 0
-            raise StopIteration
-        else:
-            self.iter_position += 1
-            return self.metadata[self.iter_position - 1]
+        if self._metadata is not None:
+            return iter(self._metadata)
+        return self.stream()
 
     def __getitem__(self, key):
+        if type(key) == slice:
+            return self.hydrate(key)
+        item = self.metadata[key]
+        return create_class({'server': self.server, **item})
+
+    def hydrate(self, key=slice(None), workers=16):
+        """
+        Build the entities of the collection (or of a slice of it) in parallel, returning a BatchResult
+        in collection order. Items that fail to load are None, with their error in `errors` keyed by position.
+        """
         items = self.metadata[key]
-        if type(items) == list:
-            return [create_class(item) for item in items]
-        else:
-            return create_class(items)
+        positions = list(range(len(self.metadata))[key])
+        return load_batch(items, lambda item: create_class({'server': self.server, **item}), workers=workers, keys=positions)
 
     def __len__(self):
         return len(self.metadata)
@@ -111,7 +129,7 @@ class Collection:
         Getter for the a collection object. In this case dataset and layers
         are the objects in the API. I.e. tables are a dataset type.
         """
-        metadata = self.get_metadata()
+        metadata = self.metadata
         id_hashes = [item.get('attributes').get('dataset') for item in metadata if len(metadata) > 0]
         for id_hash in id_hashes:
             collection=[]
@@ -133,7 +151,7 @@ class Collection:
 
     def get_metadata(self):
         url = f"{self.server}/v1/search"
-        r = requests.get(url, params=self.payload, headers=self.User.headers)
+        r = transport.get(url, params=self.payload, headers=self.User.read_headers)
         response_list = r.json().get('data', None)
         if not response_list:
             raise ValueError('No items found')
@@ -141,6 +159,48 @@ class Collection:
         # in the future changing this to metadata native type is the right thing to do
         return response_list
 
+    def pages(self, page_size=100):
+        """
+        Generator of the pages (lists of search results) of the search, requested one at a time
+        with `page[size]` and `page[number]`.
+        """
+        url = f"{self.server}/v1/search"
+        number = 1
+        previous = None
+        while True:
+            params = {**self.payload, 'page[size]': page_size, 'page[number]': number}
+            r = transport.get(url, params=params, headers=self.User.read_headers)
+            if r.status_code != 200:
+                raise ValueError(f'Bad response: {r.status_code} from {r.url}')
+            body = r.json()
+            page = body.get('data') or []
+            # Stop on the last page, or if the server ignores the paging parameters and repeats itself
+            if not page or page[0].get('id') == previous:
+                return
+            yield page
+            links = body.get('links') or {}
+            if len(page) < page_size or ('links' in body and not links.get('next')):
+                return
+            previous = page[0].get('id')
+            number += 1
+
+    def stream(self, page_size=100, prefetch=1):
+        """
+        Lazily yield search results page by page, up to `limit` items, without holding the whole
+        result in memory. With `prefetch` > 0, up to that many following pages are downloaded in a
+        background thread while earlier results are consumed. Every call returns an independent generator.
+        """
+        pages = self.pages(page_size=page_size)
+        if prefetch:
+            pages = prefetched(pages, size=prefetch)
+        count = 0
+        for page in pages:
+            for item in page:
+                if count >= self.limit:
+                    return
+                count += 1
+                yield item
+
     # def filter_results(self, response_list):
     #     """Search by a list of strings to return a filtered list of Dataset or Layer objects"""
     #     filtered_response = []
@@ -200,47 +260,29 @@ class Collection:
     #         tmp_sorted = tmp_sorted[0:self.limit]
     #     return tmp_sorted
 
-    def save(self, path=None):
+    def save(self, path=None, workers=16, resume=True, format='files', snapshot=None):
         """
-        Save all entities in the collection to a local path.
-        """
-        if not path:
-            path = './LMI-BACKUP'
-            if not os.path.isdir(path):
-                os.mkdir(path)
-            today = datetime.datetime.today().strftime('%Y-%m-%d@%Hh-%Mm')
-            path += f'/{today}'
-            if not os.path.isdir(path):
-                os.mkdir(path)
-        else:
-           if not os.path.isdir(path):
-                os.mkdir(path)
-        print(f'Saving to path: {path}')
-        saved = []
-        failed = []
-        for item in tqdm(self):
-            if item['id'] not in saved:
-                entity_type = item.get('type')
-                if entity_type in ['Dataset']:
-                    ds_id = item['id']
-                else:
-                    ds_id = item['attributes']['dataset']
-                try:
-                    url = f'{self.server}/v1/dataset/{ds_id}?includes=metadata,layer'
-                    r = requests.get(url, headers=self.User.headers)
-                    dataset_config = r.json()['data']
-                except:
-                    failed.append(item)
-
-                save_json = {
-                    "id": ds_id,
-                    "type": "dataset",
-                    "server": self.server,
-                    "attributes": dataset_config['attributes']
-                }
-                with open(f"{path}/{ds_id}.json", 'w') as fp:
-                    json.dump(save_json, fp)
+        Save all entities in the collection to a local path (by default ./LMI-BACKUP/<date>).
 
+        Each dataset is saved once, from up to `workers` threads bounded by the transport's per-server limits.
+        Saving again to the same path resumes an interrupted backup, unless `resume=False`.
+        With format='store' the datasets are saved incrementally, as a `snapshot` of a content-addressed store;
+        with format='archive' they are streamed to a single compressed JSON Lines file at `path`.
+        See `Skydipper.backup.Backup`.
+        """
+        from .backup import Backup
+        backup = Backup(path=path, server=self.server, token=self.User._token, workers=workers, resume=resume,
+                        format=format, snapshot=snapshot)
+        print(f'Saving to path: {backup.path}')
+        items = {}
+        for item in self:
+            entity_type = item.get('type')
+            if entity_type in ['Dataset']:
+                ds_id = item['id']
+            else:
+                ds_id = item['attributes']['dataset']
+            items.setdefault(ds_id, item)
+        failed = [items[ds_id] for ds_id in backup.run(items)]
         if len(failed) > 0:
             print(f'Some entities failed to save: {failed}')
             return failed
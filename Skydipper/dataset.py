@@ -1,14 +1,11 @@
-import requests
+from .transport import transport
 import json
-import random
-import geopandas as gpd
 import os
-import datetime
 from pprint import pprint
 from .layer import Layer
-from .utils import html_box, nested_set, server_uses_widgets
+from .utils import html_box, parallel_map, dataset_includes, load_batch, BatchResult, diff, update_payload, split_limit, prefetched, rows_to_frame, has_order_by, arrow_available
 from .Skydipper import Vocabulary, Metadata, Widget
-from .user import User
+from .user import get_user
 
 class Dataset:
     """
@@ -24,44 +21,130 @@ class Dataset:
         A path/file string pointing to the location of a file for upload.
     sever: str
         A URL string of the vizzuality server.
+    token: str
+        An (optional) API token. Credentials are only resolved when a write operation needs them.
+    defer_children: bool
+        Skip the layers and widgets when loading the dataset; they are fetched on first access instead.
     """
-    def __init__(self, id_hash=None, attributes=None, server="https://api.skydipper.com", fname=None):
-        self.User = User()
+    # Attributes maintained by the server (or children), never sent in an update
+    update_blacklist = ['metadata','layer', 'vocabulary', 'updatedAt', 'userId', 'slug', "clonedHost", "errorMessage", "taskId", "dataLastUpdated"]
+
+    def __init__(self, id_hash=None, attributes=None, server="https://api.skydipper.com", fname=None, token=None,
+                 defer_children=False):
+        self.User = get_user(token=token)
         self.id = id_hash
-        self.layers = []
         self.server = server
         self.fname = fname
         if not attributes and not fname:
             # Pull back a dataset from an id
-            self.attributes = self.get_dataset()
-        elif attributes and self.User.token and not fname and not id_hash:
+            self.attributes = self.get_dataset(defer_children=defer_children)
+        elif attributes and not fname and not id_hash and self.User.has_credentials():
             # Create a dataset from a dictionary
             self.id = self.new_dataset(attributes=attributes)
             self.attributes = self.get_dataset()
-        elif attributes and self.User.token and fname:
+        elif attributes and fname and self.User.has_credentials():
             # Uploading a csv file and creating a dataset
             self.connector_url = self.upload_new_file(attributes=attributes)
             self.id = self.from_csv(attributes=attributes)
             self.attributes = self.get_dataset()
-        if len(self.attributes.get('layer', [])) > 0:
-            self.layers = [Layer(id_hash=l.get('id', None), server=self.server) for l in self.attributes.get('layer')]
-            _ = self.attributes.pop('layer')
-        if len(self.attributes.get('metadata', [])) > 0:
-            self.metadata = [Metadata(attributes=m, server=self.server) for m in self.attributes.get('metadata')]
-            _ = self.attributes.pop('metadata')
-        else:
-            self.metadata = []
-        if len(self.attributes.get('vocabulary', [])) > 0:
-            self.vocabulary =[Vocabulary(attributes=v, server=self.server) for v in self.attributes.get('vocabulary')]
-            _ = self.attributes.pop('vocabulary')
+        self.set_children(defer_children=defer_children)
+        self.url = f"{self.server}/v1/dataset/{self.id}"
+
+    @classmethod
+    def from_payload(cls, payload, server="https://api.skydipper.com", token=None):
+        """
+        Build a Dataset from a dataset document returned by the API, including the layers, widgets,
+        vocabularies and metadata embedded by `includes=`, without any further request.
+        """
+        dataset = cls.__new__(cls)
+        dataset.User = get_user(token=token)
+        dataset.id = payload.get('id')
+        dataset.server = server
+        dataset.fname = None
+        dataset.attributes = dict(payload.get('attributes'))
+        dataset.set_children()
+        dataset.url = f"{server}/v1/dataset/{dataset.id}"
+        return dataset
+
+    @classmethod
+    def from_ids(cls, ids, server="https://api.skydipper.com", token=None, workers=16, chunk_size=100):
+        """
+        Load many datasets at once, returning a BatchResult in the order of `ids`.
+
+        Datasets are requested `chunk_size` at a time with the API's `ids` filter (in parallel, up to
+        `workers` requests). Any id the filter did not return is loaded on its own; ids that fail
+        are None in the result, with their error in `result.errors`.
+        """
+        ids = list(ids)
+        user = get_user(token=token)
+        includes = dataset_includes(server)
+        unique = list(dict.fromkeys(ids))
+        chunks = [unique[i:i + chunk_size] for i in range(0, len(unique), chunk_size)]
+
+        def fetch(chunk):
+            params = {'ids': ','.join(chunk), 'includes': includes, 'page[size]': len(chunk)}
+            r = transport.get(f'{server}/v1/dataset', params=params, headers=user.read_headers)
+            if r.status_code != 200:
+                raise ValueError(f'Bad response: {r.status_code} from {r.url}')
+            return r.json().get('data') or []
+
+        found = {}
+        for docs in parallel_map(fetch, chunks, workers=workers, return_exceptions=True):
+            if not isinstance(docs, Exception):
+                found.update({doc.get('id'): cls.from_payload(doc, server=server, token=token) for doc in docs})
+        missing = [i for i in unique if i not in found]
+        fallback = load_batch(missing, lambda i: cls(id_hash=i, server=server, token=token), workers=workers)
+        found.update({i: d for i, d in zip(missing, fallback) if d is not None})
+        return BatchResult([found.get(i) for i in ids], fallback.errors)
+
+    def set_children(self, defer_children=False):
+        """
+        Build the child entities from the documents embedded in the attributes by `includes=`, without
+        requesting them again. With `defer_children=True` layers and widgets are left to be fetched on first access.
+        """
+        layers = self.attributes.pop('layer', None)
+        widgets = self.attributes.pop('widget', None)
+        if defer_children:
+            self._layers = None
+            self._widget = None
         else:
-            self.vocabulary = []
-        if len(self.attributes.get('widget', [])) > 0:
-            self.widget =[Widget(w.get('id'), attributes=1, server=self.server) for w in self.attributes.get('widget')]
-            _ = self.attributes.pop('widget')
+            self._layers = [Layer.from_payload(l, server=self.server, token=self.User._token) for l in layers or []]
+            self._widget = [Widget.from_payload(w, server=self.server) for w in widgets or []]
+        self.metadata = [Metadata(attributes=m, server=self.server) for m in self.attributes.pop('metadata', None) or []]
+        self.vocabulary = [Vocabulary(attributes=v, server=self.server) for v in self.attributes.pop('vocabulary', None) or []]
+
+    @property
+    def layers(self):
+        """Child layers, fetched on first access if the dataset was loaded with `defer_children=True`."""
+        if self._layers is None:
+            self._layers = [Layer.from_payload(l, server=self.server, token=self.User._token) for l in self.get_children('layer')]
+        return self._layers
+
+    @layers.setter
+    def layers(self, value):
+        self._layers = value
+
+    @property
+    def widget(self):
+        """Child widgets, fetched on first access if the dataset was loaded with `defer_children=True`."""
+        if self._widget is None:
+            self._widget = [Widget.from_payload(w, server=self.server) for w in self.get_children('widget')]
+        return self._widget
+
+    @widget.setter
+    def widget(self, value):
+        self._widget = value
+
+    def get_children(self, kind):
+        """
+        Returns the documents of one kind of child entity ('layer' or 'widget') embedded in the dataset.
+        """
+        url = f'{self.server}/v1/dataset/{self.id}?includes={kind}'
+        r = transport.get(url, headers=self.User.read_headers)
+        if r.status_code == 200:
+            return r.json().get('data').get('attributes').get(kind) or []
         else:
-            self.widget = []
-        self.url = f"{self.server}/v1/dataset/{id_hash}?hash={random.getrandbits(16)}"
+            raise ValueError(f'Unable to get {kind}s of Dataset {self.id} from {r.url}')
 
     def __repr__(self):
         return self.__str__()
@@ -81,24 +164,20 @@ class Dataset:
         else:
             url = f'{self.server}/dataset'
             payload = {'dataset': attributes}
-            r = requests.post(url, data=json.dumps(payload), headers=self.User.headers)
+            r = transport.post(url, data=json.dumps(payload), headers=self.User.headers)
             if r.status_code == 200:
                 return r.json()['data']['id']
             else:
                 raise ValueError(f"Failed to create new dataset. Server response: {r.status_code}. {r.json()}")
 
 
-    def get_dataset(self):
+    def get_dataset(self, defer_children=False):
         """
-        Retrieve a dataset from a server by ID.
+        Retrieve a dataset from a server by ID. With `defer_children=True` layers and widgets are not included.
         """
         try:
-            hash = random.getrandbits(16)
-            if server_uses_widgets(self.server):
-                url = f'{self.server}/v1/dataset/{self.id}?includes=layer,widget,vocabulary,metadata&hash={hash}'
-            else:
-                url = f'{self.server}/v1/dataset/{self.id}?includes=layer,metadata&hash={hash}'
-            r = requests.get(url, headers=self.User.headers)
+            url = f'{self.server}/v1/dataset/{self.id}?includes={dataset_includes(self.server, defer_children)}'
+            r = transport.get(url, headers=self.User.read_headers)
         except:
             raise ValueError(f'Unable to get Dataset {self.id} from {r.url}')
         if r.status_code == 200:
@@ -119,7 +198,7 @@ class Dataset:
             data = { 'provider': attributes.get('provider') }
         except:
             return ValueError(f'Attributes must specify a provider type to upload a file.')
-        r = requests.post(url, headers=self.User.headers, files=files, data=data)
+        r = transport.post(url, headers=self.User.headers, files=files, data=data)
         try:
             return r.json().get('connectorUrl')
         except:
@@ -140,13 +219,14 @@ class Dataset:
         payload = {
             'dataset': attributes
         }
-        r = requests.post(url, data=json.dumps(payload), headers=self.User.headers)
+        r = transport.post(url, data=json.dumps(payload), headers=self.User.headers)
         try:
             return r.json().get('data').get('id')
         except:
             raise ValueError(f"Response returned {r.json()}, with {r.status_code}")
 
-    def query(self, sql="SELECT * FROM data LIMIT 5"):
+    def query(self, sql="SELECT * FROM data LIMIT 5", parallel=None, chunk_size=10000, order_by='cartodb_id', columnar=None,
+              decode_geometry=True):
         """
         Query a Dataset object
 
@@ -157,19 +237,172 @@ class Dataset:
         ----------
         sql: str
             Valid SQL string.
+        parallel: int
+            Fetch large results as pages of `chunk_size` rows, `parallel` at a time (see `query_parallel`).
+        chunk_size: int
+            Number of rows per page when `parallel` is set.
+        order_by: str
+            ORDER BY clause making page boundaries stable when `parallel` is set, for queries without one.
+        columnar: bool
+            Decode the rows into typed Arrow columns before building the table (default: when pyarrow is installed).
+        decode_geometry: bool
+            Decode geometry columns (hex WKB, GeoJSON or WKT) into the geometry of the table.
+        """
+        if parallel:
+            return self.query_parallel(sql, workers=parallel, chunk_size=chunk_size, order_by=order_by, columnar=columnar,
+                                       decode_geometry=decode_geometry)
+        return rows_to_frame(self.query_rows(self.query_sql(sql)), columnar=columnar, decode_geometry=decode_geometry)
+
+    def query_parallel(self, sql, workers=4, chunk_size=10000, order_by='cartodb_id', columnar=None, decode_geometry=True):
+        """
+        Query a Dataset by pages fetched concurrently: the rows are first counted, then the LIMIT/OFFSET
+        pages are requested from up to `workers` threads (under the transport's rate and concurrency limits).
+        Completed pages are spilled to a temporary folder rather than held in memory, and are reassembled in order.
+
+        Pages only partition the result if its order is stable: queries without an ORDER BY are ordered by
+        `order_by` (default cartodb_id), and are refused if `order_by` is None.
+        """
+        import tempfile
+        import pandas as pd
+        import geopandas as gpd
+        base, limit, offset = split_limit(self.query_sql(sql))
+        count = self.query_rows(f'SELECT count(*) FROM ({base}) AS q')[0]['count']
+        total = max(0, count - offset)
+        if limit is not None:
+            total = min(total, limit)
+        if not has_order_by(base):
+            if not order_by:
+                raise ValueError('Parallel queries need a stable row order: add an ORDER BY to the query or pass order_by.')
+            base += f' ORDER BY {order_by}'
+        pages = [(start, min(chunk_size, offset + total - start)) for start in range(offset, offset + total, chunk_size)]
+        with tempfile.TemporaryDirectory(prefix='skydipper-query-') as folder:
+            def fetch(page):
+                start, size = page
+                rows = self.query_rows(f'{base} LIMIT {size} OFFSET {start}') or []
+                path = f'{folder}/{start}.json'
+                with open(path, 'w') as f:
+                    json.dump(rows, f)
+                return path
+
+            frames = []
+            for path in parallel_map(fetch, pages, workers=workers):
+                with open(path) as f:
+                    frames.append(rows_to_frame(json.load(f), columnar=columnar, decode_geometry=decode_geometry))
+                os.remove(path)
+        if not frames:
+            return gpd.GeoDataFrame()
+        return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True))
+
+    def query_cached(self, sql="SELECT * FROM data", cache=None, refresh=False, **kwargs):
+        """
+        Query a Dataset through a local Parquet cache: the first call runs the query and stores its result,
+        later calls with the same SQL and options open the stored result (memory-mapped) instead of querying
+        again, until the dataset's `updatedAt` changes. Datasets without `updatedAt` are not cached. Requires pyarrow.
+
+        Parameters
+        ----------
+        sql: str
+            Valid SQL string.
+        cache: QueryCache
+            The cache to use (default `Skydipper.cache.query_cache`).
+        refresh: bool
+            Run the query even if a cached result exists, replacing it.
+        kwargs:
+            Passed to `query` (e.g. parallel, chunk_size, order_by).
+        """
+        from .cache import query_cache
+        cache = cache or query_cache
+        updated_at = self.attributes.get('updatedAt')
+        if not updated_at:
+            print(f'WARNING - Dataset {self.id} has no updatedAt to invalidate cached queries, not caching.')
+            return self.query(sql, **kwargs)
+        # The SQL actually sent: parallel queries are ordered (see query_parallel)
+        effective_sql = self.query_sql(sql)
+        if kwargs.get('parallel'):
+            base, limit, offset = split_limit(effective_sql)
+            order_by = kwargs.get('order_by', 'cartodb_id')
+            if order_by and not has_order_by(base):
+                effective_sql = f'{base} ORDER BY {order_by} LIMIT {limit} OFFSET {offset}'
+        key = cache.key(self.id, effective_sql, updated_at, columnar=arrow_available(kwargs.get('columnar')),
+                        decode_geometry=kwargs.get('decode_geometry', True))
+        table = None if refresh else cache.get(key)
+        if table is None:
+            table = self.query(sql, **kwargs)
+            cache.put(key, table)
+        return table
+
+    def to_parquet(self, path, sql="SELECT * FROM data", **kwargs):
+        """
+        Query a Dataset and write the result to a (Geo)Parquet file, returning its path.
+        Keyword arguments are passed to `query`.
+        """
+        from .cache import write_parquet
+        return write_parquet(self.query(sql, **kwargs), path)
+
+    def query_sql(self, sql):
+        """
+        Returns the SQL sent to the query service for `sql`, with the `data` table replaced by the table name.
         """
         provider = self.attributes.get('provider', None)
         if provider != 'cartodb':
             raise ValueError(f"Provider must be 'cartodb', not {provider}.")
-        sql = sql.lower().replace('from data',f"FROM {self.attributes.get('tableName')}")
+        return sql.lower().replace('from data',f"FROM {self.attributes.get('tableName')}")
+
+    def query_rows(self, sql):
+        """
+        Returns the rows (a list of dictionaries) of a query prepared by `query_sql`.
+        """
         params = {"sql": sql}
         queryURL = f"{self.server}/v1/query/{self.id}"
-        r = requests.get(url=queryURL, params=params, headers=self.User.headers)
+        r = transport.get(url=queryURL, params=params, headers=self.User.read_headers)
         if r.status_code == 200:
-            return gpd.GeoDataFrame(r.json().get('data'))
+            return r.json().get('data')
         else:
             raise ValueError(f"Bad response from Query service {r.status_code}: {r.json()}")
 
+    def query_iter(self, sql="SELECT * FROM data", chunk_size=1000, prefetch=1, order_by='cartodb_id', columnar=None,
+                   decode_geometry=True):
+        """
+        Query a Dataset page by page, yielding a GeoDataFrame of up to `chunk_size` rows as each page arrives,
+        so the whole result never has to fit in memory.
+
+        Pages are requested with LIMIT/OFFSET; a LIMIT (and OFFSET) at the end of `sql` bounds the rows returned.
+
+        Parameters
+        ----------
+        sql: str
+            Valid SQL string.
+        chunk_size: int
+            Number of rows per page.
+        prefetch: int
+            Number of following pages downloaded in the background while a chunk is processed (0 to disable).
+        order_by: str
+            ORDER BY clause making page boundaries stable, for queries without one (None to leave them unordered).
+        columnar: bool
+            Decode the rows into typed Arrow columns before building each chunk (default: when pyarrow is installed).
+        decode_geometry: bool
+            Decode geometry columns (hex WKB, GeoJSON or WKT) into the geometry of each chunk.
+        """
+        base, limit, offset = split_limit(self.query_sql(sql))
+        if order_by and not has_order_by(base):
+            base += f' ORDER BY {order_by}'
+
+        def pages():
+            position, remaining = offset, limit
+            while remaining is None or remaining > 0:
+                size = chunk_size if remaining is None else min(chunk_size, remaining)
+                rows = self.query_rows(f'{base} LIMIT {size} OFFSET {position}') or []
+                if rows:
+                    yield rows
+                if len(rows) < size:
+                    return
+                position += size
+                if remaining is not None:
+                    remaining -= size
+
+        chunks = prefetched(pages(), size=prefetch) if prefetch else pages()
+        return (rows_to_frame(rows, columnar=columnar, decode_geometry=decode_geometry) for rows in chunks)
+
 
     def head(self, n=5, decode_geom=True):
         """
@@ -182,8 +415,7 @@ class Dataset:
         """
         Returns a list of attribute keys which could be updated.
         """
-        update_blacklist = ['metadata','layer', 'vocabulary', 'updatedAt', 'userId', 'slug', "clonedHost", "errorMessage", "taskId", "dataLastUpdated"]
-        updatable_fields = {f'{k}':v for k,v in self.attributes.items() if k not in update_blacklist}
+        updatable_fields = {f'{k}':v for k,v in self.attributes.items() if k not in self.update_blacklist}
         uk = list(updatable_fields.keys())
         return uk
 
@@ -197,36 +429,35 @@ class Dataset:
         ----------
         update_params: dic
             A dictionary object containing {key: value} pairs of attributes to update.
+            Nested values can be set with dotted keys, e.g. {'layerConfig.body.maxzoom': 10}.
         show_difference: bool
             If set to True a verbose description of the updates will be returned to the user.
+
+        Only the top-level attributes that change are sent, updates changing nothing are skipped,
+        and the dataset is refreshed from the PATCH response.
         """
-        if not self.User.token:
-            raise ValueError(f'[token=None] API TOKEN required for updates.')
-        update_blacklist = ['metadata','layer', 'vocabulary', 'updatedAt', 'userId', 'slug', "clonedHost", "errorMessage", "taskId", "dataLastUpdated"]
-        attributes = {f'{k}':v for k,v in self.attributes.items() if k not in update_blacklist}
         if not update_params:
             raise ValueError(f'[update_params=None] Must specify update parameters.')
-        else:
-            payload = {}
-            for k, v in update_params.items():
-                if '.' in k:
-                    nested_keys = k.split('.')
-                    if len(nested_keys) > 1 and nested_keys[0] in list(attributes.keys()):
-                        payload[nested_keys[0]] = attributes.get(nested_keys[0])
-                        nested_set(payload, nested_keys, v)
-                elif k in list(attributes.keys()):
-                    payload[k] = v
+        payload = update_payload(self.attributes, update_params, self.update_keys())
+        if not payload:
+            print('Nothing to update.')
+            return self
+        if not self.User.token:
+            raise ValueError(f'[token=None] API TOKEN required for updates.')
         try:
             url = f"{self.server}/dataset/{self.id}"
-            r = requests.patch(url, data=json.dumps(payload), headers=self.User.headers)
+            r = transport.patch(url, data=json.dumps(payload), headers=self.User.headers)
         except:
             raise ValueError(f'Dataset update failed.')
-        if r.status_code == 200:
-            response = r.json()['data']
-        else:
-            pass
+        if r.status_code != 200:
             return None
-        self.attributes = self.get_dataset()
+        previous = self.attributes
+        response = r.json().get('data') or {}
+        self.attributes = response.get('attributes') or self.get_dataset()
+        for child in ['layer', 'widget', 'metadata', 'vocabulary']:
+            self.attributes.pop(child, None)
+        if show_difference:
+            pprint(diff(previous, self.attributes))
         return self
 
     def confirm_delete(self):
@@ -269,7 +500,7 @@ class Dataset:
             try:
                 url = f'{self.server}/dataset/{self.id}'
                 headers = {'Authorization': f'Bearer {self.User.token}', 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-                r = requests.delete(url, headers=self.User.headers)
+                r = transport.delete(url, headers=self.User.headers)
             except:
                 raise ValueError(f'Dataset deletion failed.')
             if r.status_code == 200:
@@ -282,14 +513,15 @@ class Dataset:
             print('Deletion aborted.')
         return self
 
-    def clone(self, env='staging', clone_server=None, dataset_params=None, clone_children=False):
+    def clone(self, env='staging', clone_server=None, dataset_params=None, clone_children=False, workers=8):
         """
         Create a clone of a target Dataset as a new staging or prod Dataset.
         A set of attributes can be specified for the clone Dataset.
 
         The argument `clone_server` specifies the server to clone to. Default server = https://api.skydipper.com
 
-        Set clone_children=True to clone all child layers, and widgets.
+        Set clone_children=True to clone all child layers, and widgets. Children are created from up to
+        `workers` threads, bounded by the transport's per-server limits.
         """
         if not clone_server: clone_server = self.server
         else:
@@ -312,7 +544,7 @@ class Dataset:
             }
             print(f'Creating clone dataset')
             url = f'{clone_server}/dataset'
-            r = requests.post(url, data=json.dumps(payload), headers=self.User.headers)
+            r = transport.post(url, data=json.dumps(payload), headers=self.User.headers)
             if r.status_code == 200:
                 clone_dataset_id = r.json()['data']['id']
                 clone_dataset = Dataset(id_hash=clone_dataset_id, server=clone_server)
@@ -323,18 +555,19 @@ class Dataset:
             if clone_children:
                 layers =  self.layers
                 if len(layers) > 0:
-                    for l in layers:
+                    def clone_layer(l):
                         try:
                             layer_name = l.attributes['name']
 
-                            l.clone(token=self.User.token, env=env, layer_params={'name': layer_name}, clone_server=clone_server, target_dataset_id=clone_dataset_id)
+                            l.clone(env=env, layer_params={'name': layer_name}, clone_server=clone_server, target_dataset_id=clone_dataset_id)
                         except:
                             raise ValueError(f'Layer cloning failed for {l.id}')
+                    parallel_map(clone_layer, layers, workers=workers)
                 else:
                     print("No child layers to clone!")
                 widgets =  self.widget
                 if len(widgets) > 0:
-                    for w in widgets:
+                    def clone_widget(w):
                         widget = w.attributes
                         widget_payload = {
                             "name": widget['name'],
@@ -344,14 +577,15 @@ class Dataset:
                             "application": payload['dataset']['application']
                         }
                         try:
-                            clone_dataset.add_widget(token=self.User.token, widget_params=widget_payload)
+                            clone_dataset.add_widget(widget_params=widget_payload)
                         except:
-                            raise ValueError(f'Widget cloning failed for {widget.id}')
+                            raise ValueError(f'Widget cloning failed for {w.id}')
+                    parallel_map(clone_widget, widgets, workers=workers)
                 else:
                     print("No child widgets to clone!")
                 vocabs = self.vocabulary
                 if len(vocabs) > 0:
-                    for v in vocabs:
+                    def clone_vocabulary(v):
                         vocab = v.attributes
                         vocab_payload = {
                             'application': vocab['application'],
@@ -359,12 +593,13 @@ class Dataset:
                             'tags': vocab['tags']
                         }
                         try:
-                            clone_dataset.add_vocabulary(vocab_params=vocab_payload, token=self.User.token)
+                            clone_dataset.add_vocabulary(vocab_params=vocab_payload)
                         except:
                             raise ValueError('Failed to clone Vocabulary.')
+                    parallel_map(clone_vocabulary, vocabs, workers=workers)
                 metas = self.metadata
                 if len(metas) > 0:
-                    for m in metas:
+                    def clone_metadata(m):
                         meta = m.attributes
                         meta_payload = {
                             'application': meta['application'],
@@ -372,9 +607,10 @@ class Dataset:
                             'language': meta['language']
                         }
                         try:
-                            clone_dataset.add_metadata(meta_params=meta_payload, token=self.User.token)
+                            clone_dataset.add_metadata(meta_params=meta_payload)
                         except:
                             raise ValueError('Failed to clone Metadata.')
+                    parallel_map(clone_metadata, metas, workers=workers)
             # self.attributes = Dataset(clone_dataset_id, server=clone_server).attributes
             return Dataset(id_hash=clone_dataset_id, server=clone_server)
 
@@ -400,73 +636,52 @@ class Dataset:
         sql = f"SELECT ST_SUMMARYSTATS() from {self.attributes.get('tableName')}"
         params = {"sql": sql,
                   "geostore": geometry.id}
-        r = requests.get(url, params=params, headers=self.User.headers)
+        r = transport.get(url, params=params, headers=self.User.read_headers)
         if r.status_code == 200:
             try:
                 return r.json().get('data', [{}])[0].get('st_summarystats', None)
             except:
                 raise ValueError(f'Unable to retrieve values from response {r.json()}')
         else:
-            print("Hint: sometimes this service fails due to restore on EE servers. Try again.")
-            raise ValueError(f'Bad response: {r.status_code} from query: {r.url}')
+            raise ValueError(f'Bad response: {r.status_code} from query: {r.url} (transient failures were already retried)')
 
-    def save(self, path=None):
+    def save(self, path=None, format='files', snapshot=None):
         """
-        Construct dataset json and save to local path in a date-referenced folder
+        Construct dataset json and save to local path in a date-referenced folder, with format='store'
+        to a snapshot of a content-addressed store, or with format='archive' appended to the single-file
+        archive at `path` (see `Skydipper.backup`).
         """
-        if not path:
-            path = './LMI-BACKUP'
-            if not os.path.isdir(path):
-                os.mkdir(path)
-            today = datetime.datetime.today().strftime('%Y-%m-%d@%Hh-%Mm')
-            path += f'/{today}'
-            if not os.path.isdir(path):
-                os.mkdir(path)
-        else:
-           if not os.path.isdir(path):
-                os.mkdir(path)
-        if server_uses_widgets(self.server):
-            url_args = "vocabulary,metadata,layer,widget"
-        else:
-            url_args = "metadata,layer"
+        from .backup import Backup
+        backup = Backup(path=path, server=self.server, token=self.User._token, format=format, snapshot=snapshot)
         try:
-            url = f"{self.server}/v1/dataset/{self.id}?includes={url_args}"
-            r = requests.get(url, headers=self.User.headers)
-            dataset_config = r.json()['data']
+            backup.save(self.id)
         except:
             raise ValueError(f'Could not retrieve config.')
-
-        save_json = {
-            "id": self.id,
-            "type": "dataset",
-            "server": self.server,
-            "attributes": dataset_config['attributes']
-        }
-        if not os.path.isdir(path):
-            os.mkdir(path)
-        with open(f"{path}/{self.id}.json", 'w') as fp:
-            json.dump(save_json, fp)
+        if format == 'store':
+            backup.write_snapshot(merge=True)
         print('Save complete!')
         return
 
-    def restore(self, path=None, check=True):
+    def restore(self, path=None, check=True, snapshot=None):
         """
         From a local backup at the specified path, restores and returns a previous version of the current dataset.
+        For a content-addressed store, `snapshot` selects the snapshot (e.g. a date, default the latest).
         """
+        from .backup import read_record
         if not path:
             print('Requires a file path to valid backup folder.')
             return None
         try:
-            with open(f"{path}/{self.id}.json") as f:
-                recovered_dataset = json.load(f)
+            recovered_dataset = read_record(path, self.id, snapshot=snapshot)
             server = recovered_dataset.get('server', "https://api.skydipper.com")
             if check:
                 blacklist = ['metadata','layer','widget','vocabulary', 'updatedAt']
                 attributes = {f'{k}':v for k,v in recovered_dataset['attributes'].items() if k not in blacklist}
-                difs = {f'{k}': [v, self.attributes[k]] for k,v in attributes.items() if k not in blacklist and self.attributes[k] != attributes[k]}
-                if check and self.attributes == attributes:
+                existing = {f'{k}':v for k,v in self.attributes.items() if k not in blacklist}
+                difs = diff(attributes, existing)
+                if not difs:
                     print('Loaded attributes == existing attributes')
-                elif check and self.attributes == attributes:
+                else:
                     print('Loaded attributes != existing attributes')
                     pprint(difs)
         except:
@@ -495,7 +710,7 @@ class Dataset:
             try:
                 url = f'{self.server}/v1/dataset/{ds_id}/vocabulary/{vocab_type}'
                 headers = {'Authorization': f'Bearer {self.User.token}', 'Content-Type': 'application/json'}
-                r = requests.post(url, data=json.dumps(payload), headers=headers)
+                r = transport.post(url, data=json.dumps(payload), headers=headers)
             except:
                 raise ValueError(f'Vocabulary creation failed.')
             if r.status_code == 200:
@@ -532,7 +747,7 @@ class Dataset:
             try:
                 url = f'{self.server}/v1/dataset/{ds_id}/metadata'
                 headers = {'Authorization': f'Bearer {self.User.token}', 'Content-Type': 'application/json'}
-                r = requests.post(url, data=json.dumps(payload), headers=self.Users.headers)
+                r = transport.post(url, data=json.dumps(payload), headers=self.Users.headers)
             except:
                 raise ValueError(f'Vocabulary creation failed.')
             if r.status_code == 200:
@@ -568,7 +783,7 @@ class Dataset:
             try:
                 url = f'{self.server}/v1/dataset/{ds_id}/widget'
                 print(url)
-                r = requests.post(url, data=json.dumps(payload), headers=self.User.headers)
+                r = transport.post(url, data=json.dumps(payload), headers=self.User.headers)
                 print(r.json())
             except:
                 raise ValueError(f'Widget creation failed.')
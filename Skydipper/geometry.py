@@ -1,15 +1,9 @@
-import requests
-import folium
+from .transport import transport
 import urllib
 import json
-import random
-import geopandas as gpd
-from shapely.geometry import shape
-import shapely.wkt
-import geojson
 from .utils import html_box, get_geojson_string
 import json
-from .user import User
+from .user import get_user
 
 class Geometry:
     """
@@ -25,10 +19,12 @@ class Geometry:
         The string of the server URL.
     s: obj
         A shapely object.
+    token: str
+        An (optional) API token.
     """
-    def __init__(self, id_hash=None, attributes=None, s=None, parameters=None, server='https://api.skydipper.com'):
+    def __init__(self, id_hash=None, attributes=None, s=None, parameters=None, server='https://api.skydipper.com', token=None):
         self.server = server
-        self.User = User()
+        self.User = get_user(token=token)
         if s:
             attributes = self.create_attributes_from_shapely(s)
         if parameters:
@@ -39,6 +35,18 @@ class Geometry:
             self.id = id_hash
             self.attributes = self.get_geometry()
 
+    @classmethod
+    def from_payload(cls, payload, server='https://api.skydipper.com', token=None):
+        """
+        Build a Geometry from a geostore document returned by the API, without requesting it again.
+        """
+        geometry = cls.__new__(cls)
+        geometry.server = server
+        geometry.User = get_user(token=token)
+        geometry.id = payload.get('id')
+        geometry.attributes = payload.get('attributes')
+        return geometry
+
     def __repr__(self):
         return self.__str__()
 
@@ -50,6 +58,7 @@ class Geometry:
 
     def create_attributes_from_shapely(self, s):
         """Using a Shapely object, we should build a Geometry object."""
+        import geojson
         if s.geom_type in ['Polygon', 'Point', 'MultiPoint','MultiPolygon']:
             atts={'geojson': {'type': 'FeatureCollection',
                             'features': [{'type': 'Feature',
@@ -75,7 +84,7 @@ class Geometry:
         except:
             raise ValueError(f"Unable to pass attributes. Expected valid geojson, recieved: {attributes}")
         url = self.server + '/v1/geostore'
-        r = requests.post(url, headers=self.User.headers, json=body)
+        r = transport.post(url, headers=self.User.read_headers, json=body)
         if r.status_code == 200:
             self.id = r.json().get('data').get('id')
             return r.json().get('data').get('attributes')
@@ -86,9 +95,8 @@ class Geometry:
         """
         Returns a geostore object by ID from a Vizzuality endpoint.
         """
-        hash = random.getrandbits(16)
-        url = (f'{self.server}/{version}/geostore/{self.id}?simplify={simplify}&hash={hash}')
-        r = requests.get(url, headers=self.User.headers)
+        url = f'{self.server}/{version}/geostore/{self.id}?simplify={simplify}'
+        r = transport.get(url, headers=self.User.read_headers)
         if r.status_code == 200:
             return r.json().get('data').get('attributes')
         else:
@@ -98,6 +106,8 @@ class Geometry:
         """
         Returns features as GeoDataFrame
         """
+        import geopandas as gpd
+        from shapely.geometry import shape
         attributes = self.attributes
         props = {
             **attributes['info'],
@@ -116,6 +126,7 @@ class Geometry:
         """
         Returns features as a list of Shapely geometries
         """
+        from shapely.geometry import shape
         features = self.attributes['geojson']['features']
         if len(features) > 0:
             return [shape(feature['geometry']) for feature in features]
@@ -131,7 +142,7 @@ class Geometry:
                   "band_viz": json.dumps(band_viz)
                   }
         url = "https://api.skydipper.com/v1/recent-imagery"
-        r = requests.get(url, params=params, headers=self.User.headers)
+        r = transport.get(url, params=params, headers=self.User.read_headers)
         if r.status_code == 200:
             tile_url = r.json().get('data').get('tiles')[0].get('attributes').get('tile_url')
             return tile_url
@@ -148,7 +159,7 @@ class Geometry:
                      }
             url = "/v1/composite-service"
             url = self.server + url
-            r = requests.get(url, params=params, headers=self.User.headers)
+            r = transport.get(url, params=params, headers=self.User.read_headers)
             if r.status_code == 200:
                 tile_url = r.json().get('attributes').get('tile_url')
                 return tile_url
@@ -159,7 +170,7 @@ class Geometry:
                       "date_range": date_range,
                       "band_viz": json.dumps(band_viz)
                      }
-            r = requests.request("POST", url, data=payload, headers=self.User.headers, params=params)
+            r = transport.request("POST", url, data=payload, headers=self.User.read_headers, params=params)
             if r.status_code == 200:
                 tile_url = r.json().get('attributes').get('tile_url')
                 return tile_url
@@ -190,6 +201,7 @@ class Geometry:
         color: str
             Hex code for geom outline. Default = #64D1B8.
         """
+        import folium
         if instrument == 'sentinel':
             band_viz = {'bands': ['B4', 'B3', 'B2'], 'min': 0, 'max': 0.4}
         else:
@@ -239,7 +251,7 @@ class Geometry:
                       "lang": lang,
                       "app": app}
             url = f"{self.server}/v1/geodescriber"
-            r = requests.get(url, params=params, headers=self.User.headers)
+            r = transport.get(url, params=params, headers=self.User.read_headers)
             if r.status_code == 200:
                 if self.server == 'https://api.skydipper.com':
                     tmp = r.json().get('attributes')
@@ -258,7 +270,7 @@ class Geometry:
             url = "https://api.skydipper.com/v1/geodescriber/geom"
             payload = json.dumps(self.attributes)
             querystring = {"lang": lang, "app": app}
-            r = requests.request("POST", url, data=payload, headers=self.User.headers, params=querystring)
+            r = transport.request("POST", url, data=payload, headers=self.User.read_headers, params=querystring)
             if r.status_code == 200:
                 d = {'title': r.json().get('data').get('title'),
                      'description': r.json().get('data').get('description'),
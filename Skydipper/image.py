@@ -1,13 +1,7 @@
 from .utils import html_box, get_geojson_string
-import requests
+from .transport import transport
 import json
-import folium
-import numpy as np
 import random
-import png
-import geopandas as gpd
-from shapely.geometry.polygon import LinearRing
-from shapely.geometry import shape
 
 class Image:
     """
@@ -75,7 +69,7 @@ class Image:
     def get_thumbs(self):
         payload = {'source_data': [{'source': self.source}], 'bands': self.band_viz.get('bands')}
         url = self.server + '/recent-tiles/thumbs'
-        r = requests.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
+        r = transport.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
         if  r.status_code == 200:
             return r.json().get('data').get('attributes')[0].get('thumbnail_url')
         else:
@@ -85,7 +79,7 @@ class Image:
     def get_image_url(self):
         payload = {'source_data': [{'source': self.source}], 'bands': self.band_viz.get('bands')}
         url = self.server + '/recent-tiles/tiles'
-        r = requests.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
+        r = transport.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
         if  r.status_code == 200:
             return r.json().get('data').get('attributes')[0].get('tile_url')
         else:
@@ -93,6 +87,7 @@ class Image:
             return None
 
     def get_ring(self):
+            from shapely.geometry.polygon import LinearRing
             coords = self.bbox.get('geometry').get('coordinates', None)
             if coords and any(isinstance(i, list) for i in coords[0]):
                 coords = coords[0]
@@ -113,6 +108,7 @@ class Image:
         color: str
             Hex code for geom outline. Default = #64D1B8.
         """
+        import folium
         centroid = [self.ring.centroid.xy[1][0], self.ring.centroid.xy[0][0]]
         result_map = folium.Map(location=centroid, tiles='OpenStreetMap')
         geojson_str = get_geojson_string(self.bbox['geometry'])
@@ -151,12 +147,14 @@ class Image:
             A string specifying the version of the model to use (e.g. 'v1', 'v2', 'v3'). If not provided, the latest
             version of the model will be used.
         """
+        import numpy as np
+        import png
         if model_type == 'random_forest':
             if self.type in ['Composite Image', 'Classified Image']:
                 raise ValueError(f'Unable to perform {model_type} classification on a {self.type}.')
             url = self.server + '/recent-tiles-classifier'
             params = {'img_id': self.attributes.get('provider')}
-            r = requests.get(url, params=params)
+            r = transport.get(url, params=params)
             if r.status_code == 200:
                 classified_tiles = r.json().get('data').get('attributes').get('url')
                 tmp = {'instrument': self.instrument,
@@ -184,7 +182,7 @@ class Image:
                         'model_version': None}
             url = f'https://us-central1-skydipper-196010.cloudfunctions.net/classify'
             headers = {'Content-Type': 'application/json'}
-            r = requests.post(url, data=json.dumps(payload), headers=headers)
+            r = transport.post(url, data=json.dumps(payload), headers=headers)
             if r.status_code == 200:
                 image = np.array(r.json().get('output'), dtype=np.uint8)
                 hash_code = random.getrandbits(128)
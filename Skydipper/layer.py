@@ -1,13 +1,10 @@
-import requests
-import geopandas as gpd
-import folium
+from .transport import transport
 import urllib
 import json
-import random
 import re
 from pprint import pprint
-from .utils import html_box, get_geojson_string, nested_set
-from .user import User
+from .utils import html_box, get_geojson_string, load_batch, update_payload, arrow_available, rows_to_frame, csv_to_frame
+from .user import get_user
 
 class Layer:
     """
@@ -21,17 +18,21 @@ class Layer:
         A dictionary holding the attributes of a dataset.
     server: str
         A string of the server URL.
+    token: str
+        An (optional) API token. Credentials are only resolved when a write operation needs them.
     """
+    # Attributes maintained by the server, never sent in an update
+    update_blacklist = ['updatedAt', 'userId', 'dataset', 'slug']
+
     def __init__(self, id_hash=None, attributes=None,
-                    server="https://api.skydipper.com", mapbox_token=None):
+                    server="https://api.skydipper.com", mapbox_token=None, token=None):
         self.server = server
-        self.User = User()
-        self.token = self.User.token
+        self.User = get_user(token=token)
         self.mapbox_token = mapbox_token
         if not attributes and id_hash:
             self.id = id_hash
             self.attributes = self.get_layer()
-        elif attributes and self.token:
+        elif attributes and self.User.has_credentials():
             created_layer = self.new_layer(attributes=attributes, server=self.server)
             self.attributes = created_layer.attributes
             self.id = created_layer.id
@@ -39,6 +40,33 @@ class Layer:
             self.id = attributes.get('id')
             self.attributes = self.get_layer()
 
+    @classmethod
+    def from_payload(cls, payload, server="https://api.skydipper.com", mapbox_token=None, token=None):
+        """
+        Build a Layer from a layer document returned by the API (`{'id': ..., 'attributes': {...}}`),
+        e.g. one embedded in a dataset's includes, without requesting it again.
+        """
+        layer = cls.__new__(cls)
+        layer.server = server
+        layer.User = get_user(token=token)
+        layer.mapbox_token = mapbox_token
+        layer.id = payload.get('id')
+        layer.attributes = payload.get('attributes')
+        return layer
+
+    @classmethod
+    def from_ids(cls, ids, server="https://api.skydipper.com", mapbox_token=None, token=None, workers=16):
+        """
+        Load many layers at once with bounded parallel requests, returning a BatchResult in the order
+        of `ids`. Ids that fail are None in the result, with their error in `result.errors`.
+        """
+        return load_batch(ids, lambda i: cls(id_hash=i, server=server, mapbox_token=mapbox_token, token=token), workers=workers)
+
+    @property
+    def token(self):
+        """The API token, resolved on first use by a write operation."""
+        return self.User.token
+
     def __repr__(self):
         return self.__str__()
 
@@ -53,9 +81,8 @@ class Layer:
         Returns a layer from the Skydipper API.
         """
         try:
-            hash = random.getrandbits(16)
-            url = f'{self.server}/v1/layer/{self.id}?includes=metadata&hash={hash}'
-            r = requests.get(url, headers=self.User.headers)
+            url = f'{self.server}/v1/layer/{self.id}?includes=metadata'
+            r = transport.get(url, headers=self.User.read_headers)
         except:
             raise ValueError(f'Unable to get Layer {self.id} from {r.url}')
         if r.status_code == 200:
@@ -139,7 +166,7 @@ class Layer:
         }))
         apiParams = f"?stat_tag=API&config={_layerTpl}"
         url = f"http://35.233.41.65/user/skydipper/api/v1/map{apiParams}"
-        r = requests.get(url, headers={'Content-Type': 'application/json'})
+        r = transport.get(url, headers={'Content-Type': 'application/json'})
         try:
             tile_url = r.json().get('metadata').get('tilejson').get('raster').get('tiles')[0]
             return tile_url
@@ -153,7 +180,7 @@ class Layer:
         if vector_target and vector_target.lower() == 'mapbox':
             vector_source = layerConfig['body'].get('url', '').split('mapbox://')[1]
             url = f"https://api.mapbox.com/v4/{vector_source}.json?secure&access_token={self.mapbox_token}"
-            r = requests.get(url, headers={'Content-Type': 'application/json'})
+            r = transport.get(url, headers={'Content-Type': 'application/json'})
             if r.status_code == 200:
                 return r.json().get('tiles', [None])[0].replace('vector.pbf', 'png')
             else:
@@ -180,6 +207,7 @@ class Layer:
         color: str
             Hex code for geom outline. Default = #64D1B8.
         """
+        import folium
         url = self.parse_map_url()
         map = folium.Map(
                 location=[lon, lat],
@@ -215,8 +243,7 @@ class Layer:
         """
         Returns a list of theattribute values which could be updated
         """
-        update_blacklist = ['updatedAt', 'userId', 'dataset', 'slug']
-        updatable_fields = {f'{k}':v for k,v in self.attributes.items() if k not in update_blacklist}
+        updatable_fields = {f'{k}':v for k,v in self.attributes.items() if k not in self.update_blacklist}
         uk = list(updatable_fields.keys())
         return uk
 
@@ -230,36 +257,30 @@ class Layer:
         ----------
         update_params: dic
             A dictionary of update paramters. You can identify the possible keys by calling
-            self.update_keys(silent=False)
+            self.update_keys(silent=False). Nested values can be set with dotted keys, e.g.
+            {'layerConfig.body.maxzoom': 12}.
+
+        Only the top-level attributes that change are sent, updates changing nothing are skipped,
+        and the layer is refreshed from the PATCH response.
         """
-        if not self.token:
-            raise ValueError(f'[token=None] API TOKEN required for updates.')
-        update_blacklist = ['updatedAt', 'userId', 'dataset', 'slug']
-        attributes = {f'{k}':v for k,v in self.attributes.items() if k not in update_blacklist}
         if not update_params:
             raise ValueError(f'[update_params=None] Must specify update parameters.')
-        else:
-            payload = {}
-            for k, v in update_params.items():
-                if '.' in k:
-                    nested_keys = k.split('.')
-                    if len(nested_keys) > 1 and nested_keys[0] in list(attributes.keys()):
-                        payload[nested_keys[0]] = attributes.get(nested_keys[0])
-                        nested_set(payload, nested_keys, v)
-                elif k in list(attributes.keys()):
-                    payload[k] = v
+        payload = update_payload(self.attributes, update_params, self.update_keys())
+        if not payload:
+            print('Nothing to update.')
+            return self
+        if not self.token:
+            raise ValueError(f'[token=None] API TOKEN required for updates.')
         try:
             url = f"{self.server}/dataset/{self.attributes['dataset']}/layer/{self.id}"
-            headers = {'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'}
-            r = requests.patch(url, data=json.dumps(payload), headers=self.User.headers)
+            r = transport.patch(url, data=json.dumps(payload), headers=self.User.headers)
         except:
             raise ValueError(f'Layer update failed.')
-        if r.status_code == 200:
-            response = r.json()['data']
-        else:
+        if r.status_code != 200:
             print(f"PATCH attempt threw a {r.status_code}!")
             return None
-        self.attributes = self.get_layer()
+        response = r.json().get('data') or {}
+        self.attributes = response.get('attributes') or self.get_layer()
         return self
 
     def confirm_delete(self):
@@ -286,7 +307,7 @@ class Layer:
         if conf:
             try:
                 url = f'{self.server}/dataset/{self.attributes["dataset"]}/layer/{self.id}'
-                r = requests.delete(url, headers=self.User.headers)
+                r = transport.delete(url, headers=self.User.headers)
             except:
                 raise ValueError(f'Layer deletion failed.')
             if r.status_code == 200:
@@ -334,7 +355,7 @@ class Layer:
             }
             print(f'Creating clone dataset')
             url = f'{clone_server}/dataset'
-            r = requests.post(url, data=json.dumps(payload), headers=self.User.headers)
+            r = transport.post(url, data=json.dumps(payload), headers=self.User.headers)
             print(r.url)
             pprint(payload)
             if r.status_code == 200:
@@ -358,7 +379,7 @@ class Layer:
         }
         print(f'Creating clone layer on target dataset')
         url = f'{clone_server}/dataset/{target_dataset_id}/layer'
-        r = requests.post(url, data=json.dumps(payload), headers=self.User.headers)
+        r = transport.post(url, data=json.dumps(payload), headers=self.User.headers)
         if r.status_code == 200:
                 clone_layer_id = r.json()['data']['id']
         else:
@@ -386,10 +407,14 @@ class Layer:
             return self.get_carto_query(sql)
         return None
 
-    def get_carto_query(self, sql):
+    def get_carto_query(self, sql, columnar=None, decode_geometry=True):
         """
         Intersect layer against some geometry class object, geosjon object, shapely shape, or by id.
+
+        With pyarrow installed (or `columnar=True`), the result is requested as a CSV export
+        and parsed straight into typed Arrow columns. Geometry columns are decoded unless `decode_geometry=False`.
         """
+        columnar = arrow_available(columnar)
         attributes = self.attributes
         sql_config = attributes.get('layerConfig').get('sql_config', None)
         layerConfig = attributes.get('layerConfig')
@@ -409,9 +434,13 @@ class Layer:
         account = layerConfig.get('account')
         urlCarto = f"https://{account}.carto.com/api/v2/sql"
         params = {"q": sql}
-        r = requests.get(urlCarto, params=params)
+        if columnar:
+            params['format'] = 'csv'
+        r = transport.get(urlCarto, params=params)
         if r.status_code == 200:
-            return gpd.GeoDataFrame(r.json().get('rows'))
+            if columnar:
+                return csv_to_frame(r.content, decode_geometry=decode_geometry)
+            return rows_to_frame(r.json().get('rows'), columnar=False, decode_geometry=decode_geometry)
         else:
             print(f'{r.url}')
             raise ValueError(f"Bad response from Carto {r.status_code}: {r.json()}")
@@ -447,7 +476,7 @@ class Layer:
         sql = f"SELECT ST_SUMMARYSTATS() from {self.attributes.get('layerConfig').get('assetId')}"
         params = {"sql": sql,
                   "geostore": geometry.id}
-        r = requests.get(url, params=params, headers=self.User.headers)
+        r = transport.get(url, params=params, headers=self.User.read_headers)
         if r.status_code == 200:
             try:
                 return r.json().get('data', None)[0].get('st_summarystats')
@@ -457,28 +486,29 @@ class Layer:
             print("Hint: sometimes this service fails due to restore on EE servers. Try again.")
             raise ValueError(f'Bad response: {r.status_code} from query: {r.url}')
 
-    def save(self, path=None):
+    def save(self, path=None, format='files', snapshot=None):
         """
         Construct dataset json and save to local path in a date-referenced folder
         """
         from .dataset import Dataset
-        self.dataset().save(path=path)
+        self.dataset().save(path=path, format=format, snapshot=snapshot)
 
-    def restore(self, path=None, check=True):
+    def restore(self, path=None, check=True, snapshot=None):
         """
         From a local backup at the specified path, restores and returns a previous version of the current dataset.
+        For a content-addressed store, `snapshot` selects the snapshot (e.g. a date, default the latest).
         """
         from .dataset import Dataset
+        from .backup import read_record
         if not path:
             print('Requires a file path to valid backup .json file.')
             return None
         try:
             ds = self.dataset()
-            with open(f"{path}/{ds.id}.json") as f:
-                recovered_dataset = json.load(f)
-            layers = recovered_dataset['attributes']['layer']
+            recovered_dataset = read_record(path, ds.id, snapshot=snapshot)
+            layers = {l['id']: l for l in recovered_dataset['attributes']['layer']}
             server = recovered_dataset.get('server', "https://api.skydipper.com")
-            if len(layers) > 0: recovered_layer = [l for l in layers if l['id'] == self.id][0]
+            if self.id in layers: recovered_layer = layers[self.id]
             else: raise ValueError(f'No save layers found!')
             if check:
                 blacklist = ['updatedAt']
@@ -507,7 +537,7 @@ class Layer:
             dataset_id = attributes['dataset']
             url = f'{server}/v1/dataset/{dataset_id}/layer'
             payload = {**attributes}
-            r = requests.post(url, data=json.dumps(payload), headers=self.User.headers)
+            r = transport.post(url, data=json.dumps(payload), headers=self.User.headers)
             if r.status_code == 200:
                 new_layer_id = r.json()['data']['id']
             else:
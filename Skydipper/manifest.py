@@ -1,4 +1,4 @@
-import python_jsonschema_objects as pjs
+import functools
 from datetime import datetime
 import iso8601
 
@@ -590,8 +590,25 @@ image_manifest_schema = {
 # Build classes
 
 
-manifest = pjs.ObjectBuilder(image_manifest_schema).build_classes(
-    named_only=False, standardize_names=False)
+@functools.lru_cache(maxsize=None)
+def manifest_classes():
+    """
+    Build the python-jsonschema-objects classes for the image manifest schema.
+
+    Classes are generated on first use and cached for the lifetime of the process,
+    so importing this module has no side effects.
+    """
+    import python_jsonschema_objects as pjs
+    return pjs.ObjectBuilder(image_manifest_schema).build_classes(
+        named_only=False, standardize_names=False)
+
+
+def __getattr__(name):
+    # Backwards compatible access to the generated classes as `manifest.manifest`
+    if name == 'manifest':
+        return manifest_classes()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 """# Constructor methods"""
 
@@ -616,15 +633,10 @@ def create_footprint(band_id, points):
     points = [{"x": 0.5,"y": 0.5},{"x": 0.5,"y": 1.5},{"x": 1.5,"y": 1.5},{"x": 1.5,"y": 0.5},{"x": 0.5,"y": 0.5}]
     print(create_footprint(band_id, points).serialize())
     """
+    manifest = manifest_classes()
     return(manifest.Footprint(band_id=band_id, points=points))
 
 
-# Example:
-band_id = "test"
-points = [{"x": 0.5, "y": 0.5}, {"x": 0.5, "y": 1.5}, {
-    "x": 1.5, "y": 1.5}, {"x": 1.5, "y": 0.5}, {"x": 0.5, "y": 0.5}]
-print(create_footprint(band_id, points).serialize())
-
 # Build affine transform
 
 
@@ -640,14 +652,10 @@ def create_affine_transform(args):
     args = {"scale_x": 0.0, "shear_x": 0.0, "translate_x": 0.0, "shear_y": 0.0, "scale_y": 0.0, "translate_y": 0.0}
     print(create_affine_transform(args).serialize())
     """
+    manifest = manifest_classes()
     return(manifest.AffineTransform(**args))
 
 
-# Example:
-args = {"scale_x": 0.0, "shear_x": 0.0, "translate_x": 0.0,
-        "shear_y": 0.0, "scale_y": 0.0, "translate_y": 0.0}
-print(create_affine_transform(args).serialize())
-
 # Build mask_bands
 
 
@@ -674,6 +682,7 @@ def create_mask_bands(tileset_id_list, band_ids_list=None):
     band_ids_list = [["band1", "band2"], ["band3"]]  
     print(create_mask_bands(tileset_id_list, band_ids_list=band_ids_list).serialize())
     """
+    manifest = manifest_classes()
 
     if band_ids_list:
         out = [{"tileset_id": tmp1, "band_ids": tmp2}
@@ -683,16 +692,6 @@ def create_mask_bands(tileset_id_list, band_ids_list=None):
     return(manifest.MaskBands(out))
 
 
-# Example:
-tileset_id_list = ["mask1"]
-print(create_mask_bands(tileset_id_list, band_ids_list=None).serialize())
-tileset_id_list = ["mask1", "mask2"]
-print(create_mask_bands(tileset_id_list, band_ids_list=None).serialize())
-band_ids_list = [["band1"], ["band2"]]
-print(create_mask_bands(tileset_id_list, band_ids_list=band_ids_list).serialize())
-band_ids_list = [["band1", "band2"], ["band3"]]
-print(create_mask_bands(tileset_id_list, band_ids_list=band_ids_list).serialize())
-
 # Build band_list
 
 
@@ -719,6 +718,7 @@ def create_band_list(id_list, md_list, pp_list, tsbi_list):
     id_list = ["band1", "band2"]; md_list = [[-999], [0]]; pp_list = ['MEAN', 'MODE']; tsbi_list = [3, 1]
     print(create_band_list(id_list, md_list, pp_list, tsbi_list).serialize())
     """
+    manifest = manifest_classes()
 
     # Check number of list elements
     idl = len(id_list)
@@ -761,23 +761,6 @@ def create_band_list(id_list, md_list, pp_list, tsbi_list):
     return(manifest.Bands(out))
 
 
-# Example:
-id_list = ["band1"]
-md_list = [[-999]]
-pp_list = ["MEAN"]
-tsbi_list = [3]
-print(create_band_list(id_list, md_list, pp_list, tsbi_list).serialize())
-id_list = ["band1", "band2"]
-md_list = [[-999]]
-pp_list = ["MEAN"]
-tsbi_list = [3]
-print(create_band_list(id_list, md_list, pp_list, tsbi_list).serialize())
-id_list = ["band1", "band2"]
-md_list = [[-999], [0]]
-pp_list = ['MEAN', 'MODE']
-tsbi_list = [3, 1]
-print(create_band_list(id_list, md_list, pp_list, tsbi_list).serialize())
-
 # Build sources_list
 # can be multiple uris for image mosaicing
 
@@ -795,15 +778,12 @@ def create_source_list(uris_list):
     uris_list = [["gs://my-bucket/my-image-1.tif"], ["gs://my-bucket/my-image-2.tif"]]
     print(create_source_list(uris_list).serialize())
     """
+    manifest = manifest_classes()
     return(manifest.Sources(
         [{"uris": manifest.Uris([tmp1])} for tmp1 in uris_list]
     ))
 
 
-# Example:
-uris_list = ["gs://my-bucket/my-image-1.tif", "gs://my-bucket/my-image-2.tif"]
-print(create_source_list(uris_list).serialize())
-
 # Build tilesets_list
 
 
@@ -832,6 +812,7 @@ def create_tilesets_list(uris_list, dt_list, crs_list, id_list=None):
     uris_list = [["gs://my-bucket/my-image-1.tif"], ["gs://my-bucket/my-image-2.tif"]]
     print(create_tilesets_list(uris_list, dt_list, crs_list, id_list).serialize())
     """
+    manifest = manifest_classes()
     if id_list:
         out = [{"id": manifest.ID(tmp1),
                 "sources": create_source_list(tmp2),
@@ -848,22 +829,6 @@ def create_tilesets_list(uris_list, dt_list, crs_list, id_list=None):
     return(manifest.Tilesets(out))
 
 
-# Example:
-# Single tileset (mosaic)
-dt_list = ["FLOAT32"]
-crs_list = ["EPSG:4326"]
-uris_list = [["gs://my-bucket/my-image-1.tif",
-              "gs://my-bucket/my-image-2.tif"]]
-print(create_tilesets_list(uris_list, dt_list, crs_list).serialize())
-
-# Multiple tilesets (bands)
-id_list = ["band1", "band2"]
-dt_list = ["FLOAT32", "UINT32"]
-crs_list = ["EPSG:4326", "EPSG:4326"]
-uris_list = [["gs://my-bucket/my-image-1.tif"],
-             ["gs://my-bucket/my-image-2.tif"]]
-print(create_tilesets_list(uris_list, dt_list, crs_list, id_list).serialize())
-
 # Build properties
 
 
@@ -880,6 +845,7 @@ def create_properties_dict(properties_dict=None):
     properties_dict = {"name": "my-dataset", "alternateName": "MDS", "description": "A short description"}
     print(create_properties_dict(properties_dict).serialize())
     """
+    manifest = manifest_classes()
     if properties_dict:
         out = manifest.Properties(**properties_dict)
     else:
@@ -887,12 +853,6 @@ def create_properties_dict(properties_dict=None):
     return out
 
 
-# Example
-properties_dict = {"name": "my-dataset",
-                   "alternateName": "MDS", "description": "A short description"}
-print(create_properties_dict(properties_dict).serialize())
-print(create_properties_dict().serialize())
-
 # Build time
 
 
@@ -908,22 +868,12 @@ def create_timestamp(timestamp):
     @example
     print(create_timestamp("2009-06-24T08:00:00").serialize())
     """
+    manifest = manifest_classes()
     t = int(iso8601.parse_date(timestamp).timestamp())
     #datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
     return(manifest.Timestamp(seconds=t))
 
 
-# Example:
-ts = "20180813T141403"
-print(create_timestamp(ts).serialize())
-ts = "2018-08-13T14:14:03"
-print(create_timestamp(ts).serialize())
-ts = "2018-08-13 14:14:03"
-print(create_timestamp(ts).serialize())
-# see https://www.epochconverter.com/
-# correct answer is 1534169643
-# note in gee values returned as usec!
-
 """### create_image_manifest"""
 
 # Build manifest object
@@ -977,6 +927,7 @@ def create_image_manifest(name,
     tsbi_list = [0, 0] # first band of each image 
     print(create_manifest(name, uris_list, id_list, md_list, pp_list, tsbi_list).serialize())
     """
+    manifest = manifest_classes()
 
     # Check case (mosaic or band per tileset?)
     uril = len(uris_list)
@@ -1020,54 +971,3 @@ def create_image_manifest(name,
     })
 
     return(out)
-
-
-# Example:
-# General metadata
-name = "projects/earthengine-legacy/assets/projects/some_projects/some_asset/data-folder/my-asset"
-prop_dict = {"name": "my-dataset", "alternateName": "MDS",
-             "description": "A short description"}
-start_time = "2009-06-24T08:00:00"
-end_time = "2009-06-25T08:00:00"
-
-# Single uri, single band
-id_list = ["band1"]
-uris_list = [["gs://my-bucket/my-image-1.tif"]]
-md_list = [[-999]]
-pp_list = ["MEAN"]
-tsbi_list = [0]
-dt_list = ["FLOAT32"]
-crs_list = ["EPSG:4326"]
-m = create_image_manifest(name, uris_list, dt_list, crs_list, id_list, md_list,
-                          pp_list, tsbi_list, properties_dict, start_time, end_time,
-                          footprint=None, pyramiding_policy=None, uri_prefix=None)
-print(m.serialize())
-
-# Single uri, multiple bands
-id_list = ["band1", "band2"]
-uris_list = [["gs://my-bucket/my-image-1.tif"]]
-md_list = [[-999], [0]]
-pp_list = ["MEAN", "MODE"]
-tsbi_list = [0, 1]
-dt_list = ["FLOAT32", "UINT32"]
-crs_list = ["EPSG:4326", "EPSG:4326"]
-m = create_image_manifest(name, uris_list, dt_list, crs_list, id_list, md_list,
-                          pp_list, tsbi_list, properties_dict, start_time, end_time,
-                          footprint=None, pyramiding_policy=None, uri_prefix=None)
-print(m.serialize())
-
-# One uri, per band
-id_list = ["band1", "band2"]
-uris_list = [["gs://my-bucket/my-image-band-1.tif"],
-             ["gs://my-bucket/my-image-band-2.tif"]]  # each image is a band
-md_list = [[-999], [0]]  # apply different NA values
-pp_list = ["MEAN", "MODE"]  # apply different pyramiding policy
-tsbi_list = [0, 0]  # first band of each image
-dt_list = ["FLOAT32", "UINT32"]
-crs_list = ["EPSG:4326", "EPSG:4326"]
-m = create_image_manifest(name, uris_list, dt_list, crs_list, id_list, md_list,
-                          pp_list, tsbi_list, properties_dict, start_time, end_time,
-                          footprint=None, pyramiding_policy=None, uri_prefix=None)
-print(m.serialize())
-
-
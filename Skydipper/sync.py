@@ -0,0 +1,172 @@
+from .transport import transport
+import json
+from .backup import BackupReader, fetch_record, record_hash
+from .utils import parallel_map, diff
+from .user import get_user
+from .dataset import Dataset
+from .layer import Layer
+from .Skydipper import Widget
+
+# Attributes maintained by the server, never sent in a PATCH
+READ_ONLY = ['id', 'createdAt', 'updatedAt', 'userId']
+CHILDREN = ['layer', 'widget', 'metadata', 'vocabulary']
+# Key of the differences of each kind of child in `Sync.changes`
+CHANGE_KEYS = {'layer': 'layers', 'widget': 'widgets', 'metadata': 'metadata', 'vocabulary': 'vocabulary'}
+# Children that can be patched by id; metadata and vocabulary changes are only reported
+PATCHABLE = ['layer', 'widget']
+
+
+def children(attributes, kind):
+    """The embedded children of one kind of a dataset record, keyed by id."""
+    return {c.get('id'): c.get('attributes') or {} for c in attributes.get(kind) or []}
+
+
+def patchable(key, kind='dataset'):
+    """Whether an attribute of an entity of `kind` can be sent in a PATCH, as in the entity's own update."""
+    if kind == 'widget':
+        return key in Widget.update_keys
+    blacklist = Layer.update_blacklist if kind == 'layer' else Dataset.update_blacklist
+    return key not in READ_ONLY + CHILDREN + blacklist
+
+
+def patch_payload(source, target, kind='dataset'):
+    """
+    The minimal PATCH body making `target` attributes equal to `source`: the top-level
+    attributes that differ (the API replaces top-level values as a whole), with their `source` value.
+    Attributes the server maintains for this `kind` of entity are left out.
+    """
+    keys = {path.split('.')[0] for path in diff(target, source)}
+    return {k: source.get(k) for k in sorted(keys) if patchable(k, kind)}
+
+
+class Sync:
+    """
+    Compares a backup with the live datasets of a server, in parallel.
+
+    Datasets whose backup and live records hash the same are skipped without being compared.
+    For the others, `changes` holds the structural differences of the dataset and of each of its layers,
+    widgets, metadata and vocabularies, and `patches()` the minimal PATCH requests restoring the server
+    from the backup. Metadata and vocabulary differences, and children that only exist on one side,
+    are reported in `changes` but not patched. To bring a backup in line with the server, save a new one.
+
+    Parameters
+    ----------
+    path: str
+        A backup folder, archive or store (see `Skydipper.backup`).
+    server: str
+        A URL string of the server to compare with.
+    snapshot: str
+        For a store, the snapshot to compare with (default the latest).
+    token: str
+        An (optional) API token.
+    workers: int
+        Maximum number of datasets fetched at once.
+    """
+    def __init__(self, path, server="https://api.skydipper.com", snapshot=None, token=None, workers=16):
+        self.backup = BackupReader(path, snapshot=snapshot)
+        self.server = server
+        self.User = get_user(token=token)
+        self.workers = workers
+        self.changes = {}
+        self.records = {}
+        self.errors = {}
+        self.unchanged = []
+
+    def __repr__(self):
+        return f"Sync {self.backup.path} {self.server}: {len(self.changes)} changed, {len(self.unchanged)} unchanged"
+
+    def compare(self, ds_id):
+        """Returns the (backup, live) records of a dataset if they differ, else None."""
+        live = fetch_record(ds_id, server=self.server, user=self.User)
+        if record_hash(live) == self.backup.digest(ds_id):
+            return None
+        return self.backup.get(ds_id), live
+
+    def run(self, ids=None):
+        """Compare every dataset of the backup (or only `ids`) with the server."""
+        ids = list(ids) if ids is not None else self.backup.ids()
+        results = parallel_map(self.compare, ids, workers=self.workers, return_exceptions=True)
+        self.changes, self.records, self.errors, self.unchanged = {}, {}, {}, []
+        for ds_id, result in zip(ids, results):
+            if isinstance(result, Exception):
+                self.errors[ds_id] = result
+            else:
+                changes = self.compare_records(*result) if result else None
+                if not changes or not any(changes.values()):
+                    # Identical hashes, or records only differing outside the attributes (e.g. their server)
+                    self.unchanged.append(ds_id)
+                else:
+                    self.records[ds_id] = result
+                    self.changes[ds_id] = changes
+        return self
+
+    @staticmethod
+    def compare_records(backup, live):
+        """
+        Differences between the backup and live records of a dataset, and between each of their children
+        (under 'layers', 'widgets', 'metadata' and 'vocabulary', keyed by id). The ids of children only found
+        on one side are listed by kind in 'only_in_backup' and 'only_live'.
+        """
+        old, new = backup['attributes'], live['attributes']
+        changes = {
+            'dataset': diff({k: v for k, v in old.items() if k not in CHILDREN}, {k: v for k, v in new.items() if k not in CHILDREN}),
+            'only_in_backup': {},
+            'only_live': {}
+        }
+        for kind in CHILDREN:
+            old_children, new_children = children(old, kind), children(new, kind)
+            changes[CHANGE_KEYS[kind]] = {}
+            for child_id in old_children:
+                if child_id in new_children:
+                    child_changes = diff(old_children[child_id], new_children[child_id])
+                    if child_changes:
+                        changes[CHANGE_KEYS[kind]][child_id] = child_changes
+            only_in_backup = [i for i in old_children if i not in new_children]
+            only_live = [i for i in new_children if i not in old_children]
+            if only_in_backup:
+                changes['only_in_backup'][kind] = only_in_backup
+            if only_live:
+                changes['only_live'][kind] = only_live
+        return changes
+
+    def patches(self, target='server'):
+        """
+        The minimal PATCH requests restoring the server from the backup, for the dataset and its layers
+        and widgets, as dictionaries of method, url, entity, id and json payload.
+
+        Only target='server' is supported: a backup is not updated through the API, but by saving a new one.
+        """
+        if target != 'server':
+            raise ValueError(f"Unsupported sync target '{target}': patches can only restore the server; "
+                             f"save a new backup to bring a backup in line with the server.")
+        patches = []
+        for ds_id, (backup, live) in self.records.items():
+            payload = patch_payload(backup['attributes'], live['attributes'], kind='dataset')
+            if payload:
+                patches.append({'method': 'PATCH', 'url': f'{self.server}/v1/dataset/{ds_id}',
+                                'entity': 'dataset', 'id': ds_id, 'json': payload})
+            for kind in PATCHABLE:
+                backup_children = children(backup['attributes'], kind)
+                for child_id, attributes in children(live['attributes'], kind).items():
+                    if child_id in backup_children:
+                        payload = patch_payload(backup_children[child_id], attributes, kind=kind)
+                        if payload:
+                            patches.append({'method': 'PATCH', 'url': f"{self.server}/v1/dataset/{ds_id}/{kind}/{child_id}",
+                                            'entity': kind, 'id': child_id, 'json': payload})
+        return patches
+
+    def apply(self):
+        """
+        Send the PATCH requests restoring the server from the backup. Requires an API token.
+        Returns the patches that failed.
+        """
+        headers = self.User.headers
+
+        def send(patch):
+            r = transport.patch(patch['url'], data=json.dumps(patch['json']), headers=headers)
+            if r.status_code != 200:
+                raise ValueError(f"Bad response: {r.status_code} from {patch['url']}")
+
+        patches = self.patches(target='server')
+        results = parallel_map(send, patches, workers=self.workers, return_exceptions=True)
+        return [p for p, r in zip(patches, results) if isinstance(r, Exception)]
@@ -0,0 +1,597 @@
+import threading
+import time
+import random
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: allows `rate` requests per second on average, with bursts of up to `burst`.
+    """
+    def __init__(self, rate=25, burst=50):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"TokenBucket {self.rate}/s burst={self.burst}"
+
+    def try_acquire(self):
+        """Take a token if one is available and return 0, otherwise return the seconds until one is."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD (additive increase, multiplicative decrease) concurrency limit.
+
+    The number of requests allowed in flight grows by roughly one per round of healthy responses,
+    and halves (at most once per `cooldown` seconds) on throttling, server errors or slow responses.
+
+    Parameters
+    ----------
+    initial: int
+        Starting concurrency limit.
+    minimum: int
+        Lowest concurrency limit.
+    maximum: int
+        Highest concurrency limit.
+    latency_target: float
+        Responses slower than this many seconds count as a congestion signal.
+    cooldown: float
+        Minimum number of seconds between two decreases.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=64, latency_target=5.0, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.active = 0
+        self.decreased_at = 0
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return f"AdaptiveLimiter {self.active}/{int(self.limit)}"
+
+    def try_acquire(self):
+        """Start a call if fewer than `limit` are in flight, returning whether it started."""
+        with self.condition:
+            if self.active >= int(self.limit):
+                return False
+            self.active += 1
+            return True
+
+    def acquire(self):
+        """Block until fewer than `limit` calls are in flight."""
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, ok=True, latency=None):
+        """Finish a call, adjusting the limit from its outcome."""
+        with self.condition:
+            self.active -= 1
+            if ok and (latency is None or latency <= self.latency_target):
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif time.monotonic() - self.decreased_at > self.cooldown:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.decreased_at = time.monotonic()
+            self.condition.notify_all()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without sending a request while a server's circuit breaker is open."""
+
+
+class RetryPolicy:
+    """
+    When and how long to wait before retrying a failed request.
+
+    Idempotent requests are retried on connection errors, timeouts and `statuses`; any request is
+    retried on 429 (it was not processed). Waits use full-jitter exponential backoff, unless the server
+    sends a `Retry-After` header.
+
+    Parameters
+    ----------
+    retries: int
+        Maximum number of retries of a request.
+    backoff: float
+        Base delay in seconds; attempt n waits a random time up to backoff * 2**n.
+    max_backoff: float
+        Longest delay in seconds. Responses asking to retry later than this are returned as they are.
+    statuses: tuple
+        Status codes worth retrying.
+    methods: tuple
+        Idempotent methods, retried on any transient failure.
+    """
+    def __init__(self, retries=4, backoff=0.5, max_backoff=60, statuses=(429, 500, 502, 503, 504),
+                 methods=('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+        self.methods = methods
+
+    def __repr__(self):
+        return f"RetryPolicy retries={self.retries} backoff={self.backoff}s"
+
+    def should_retry(self, method, response=None, error=None):
+        """True if a request that got `response` (or raised `error`) may be sent again."""
+        if response is not None and response.status_code == 429:
+            return True
+        if method.upper() not in self.methods:
+            return False
+        if error is not None:
+            return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+        return response is not None and response.status_code in self.statuses
+
+    def delay(self, attempt, response=None):
+        """Seconds to wait before retry number `attempt` (from 0), honouring `Retry-After`."""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the traffic of an endpoint, so a failing endpoint is not hammered.
+    Every request deposits `ratio` tokens (up to `maximum`) and every retry spends one.
+    """
+    def __init__(self, ratio=0.2, minimum=3, maximum=20):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = float(minimum)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"RetryBudget {self.tokens:.1f} tokens"
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Spend one token for a retry, returns False if the budget is exhausted."""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a server is down. After `threshold` consecutive failed requests (connection errors,
+    timeouts or `statuses`, once their retries are used up) the circuit opens and requests raise `CircuitOpenError` for `reset_timeout` seconds; then a single
+    trial request is let through, closing the circuit again if it succeeds. A trial that never reports back
+    (see `release`) is given up after another `reset_timeout`.
+
+    The transport keeps one breaker per server (scheme and host), not per endpoint: failures of one
+    endpoint open the circuit for every request to that server.
+    """
+    # Statuses of an unavailable server; other errors (e.g. a 500 from one failing entity) do not count
+    statuses = (502, 503, 504)
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.trial_at = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"CircuitBreaker {self.state}"
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def before(self, url):
+        """Raise `CircuitOpenError` unless a request to the server may be sent now."""
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half-open' and (not self.trial or time.monotonic() - self.trial_at > self.reset_timeout):
+                self.trial = True
+                self.trial_at = time.monotonic()
+                return
+        raise CircuitOpenError(f'Circuit open for {Transport.server_key(url)} after {self.failures} failures, '
+                               f'retry in {self.reset_timeout}s')
+
+    def is_failure(self, status=None, error=None):
+        """Whether the outcome of a request (its status code, or the error it raised) means the server is unavailable."""
+        if error is not None:
+            return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+        return status in self.statuses
+
+    def release(self):
+        """Give up a trial request that ended without a response or connection error to record."""
+        with self.lock:
+            self.trial = False
+
+    def record(self, ok):
+        with self.lock:
+            self.trial = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+
+
+class InFlight:
+    """A GET request currently being sent, whose result is shared by every caller asking for the same url."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class Transport:
+    """
+    Shared HTTP transport used by every Skydipper entity.
+
+    Keeps one pooled keep-alive `requests.Session` per server (scheme + host), so
+    repeated calls to the same API reuse their TCP/TLS connections.
+
+    Parameters
+    ----------
+    pool_connections: int
+        Number of connection pools to cache per session.
+    pool_maxsize: int
+        Maximum number of connections kept alive per pool.
+    timeout: float or tuple
+        Default (connect, read) timeout in seconds applied to every request.
+    headers: dic
+        Default headers sent with every request.
+    cache: ResponseCache
+        Optional cache of GET responses, revalidated with ETag/Last-Modified (see `Skydipper.cache`).
+    coalesce: bool
+        Share one in-flight request between threads concurrently GETting the same url (single-flight).
+    rate: float
+        Requests per second allowed to each server (token bucket), or None for no rate limit.
+    burst: int
+        Size of each server's token bucket.
+    max_concurrency: int
+        Upper bound of each server's adaptive (AIMD) concurrency limit.
+    retry: RetryPolicy
+        Retry policy for transient failures, or None to never retry.
+    breaker_threshold: int
+        Consecutive failures after which a server's circuit breaker opens (0 disables the breaker).
+    breaker_timeout: float
+        Seconds a server's circuit stays open before a trial request is allowed.
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=20, timeout=(10, 120), headers=None, cache=None, coalesce=True,
+                 rate=25, burst=50, max_concurrency=20, retry=None, breaker_threshold=5, breaker_timeout=30):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.cache = cache
+        self.coalesce = coalesce
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.retry = RetryPolicy() if retry is None else retry or None
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.adapters = {}
+        self.sessions = {}
+        self.limits = {}
+        self.breakers = {}
+        self.budgets = {}
+        self.inflight = {}
+        self.stats = {'requests': 0, 'coalesced': 0, 'retries': 0}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Transport {list(self.sessions.keys())}"
+
+    def configure(self, pool_connections=None, pool_maxsize=None, timeout=None, headers=None, cache=None, coalesce=None,
+                  rate=None, burst=None, max_concurrency=None, retry=None, breaker_threshold=None, breaker_timeout=None):
+        """
+        Update the transport settings. Existing sessions are closed so the new settings apply to the next request.
+        Pass `cache=False` to disable a previously configured response cache, `retry=False` to disable retries.
+        """
+        if pool_connections: self.pool_connections = pool_connections
+        if pool_maxsize: self.pool_maxsize = pool_maxsize
+        if timeout: self.timeout = timeout
+        if headers is not None: self.headers = headers
+        if cache is not None: self.cache = None if cache is False else cache
+        if coalesce is not None: self.coalesce = coalesce
+        if rate is not None: self.rate = rate or None
+        if burst: self.burst = burst
+        if max_concurrency: self.max_concurrency = max_concurrency
+        if retry is not None: self.retry = retry or None
+        if breaker_threshold is not None: self.breaker_threshold = breaker_threshold
+        if breaker_timeout is not None: self.breaker_timeout = breaker_timeout
+        self.limits = {}
+        self.breakers = {}
+        self.budgets = {}
+        self.close()
+        return self
+
+    def mount(self, prefix, adapter):
+        """
+        Register a custom `requests` adapter (e.g. with a urllib3 retry policy) for a URL prefix.
+        """
+        with self.lock:
+            self.adapters[prefix] = adapter
+            for session in self.sessions.values():
+                session.mount(prefix, adapter)
+
+    def close(self):
+        """Close every pooled session."""
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+
+    @staticmethod
+    def server_key(url):
+        """Returns the scheme://host part of a url, used to pick the pooled session."""
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session(self, url):
+        """
+        Returns the pooled session for the server of the url, creating it on first use.
+        """
+        key = self.server_key(url)
+        session = self.sessions.get(key)
+        if session:
+            return session
+        with self.lock:
+            session = self.sessions.get(key)
+            if not session:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                for prefix, custom_adapter in self.adapters.items():
+                    session.mount(prefix, custom_adapter)
+                session.headers.update(self.headers)
+                self.sessions[key] = session
+        return session
+
+    def limiters(self, url):
+        """
+        Returns the (TokenBucket, AdaptiveLimiter) pair of the url's server, creating them on first use.
+        """
+        key = self.server_key(url)
+        limits = self.limits.get(key)
+        if limits:
+            return limits
+        with self.lock:
+            if key not in self.limits:
+                bucket = TokenBucket(rate=self.rate, burst=self.burst) if self.rate else None
+                limiter = AdaptiveLimiter(initial=min(4, self.max_concurrency), maximum=self.max_concurrency)
+                self.limits[key] = (bucket, limiter)
+            return self.limits[key]
+
+    def breaker(self, url):
+        """Returns the CircuitBreaker of the url's server (shared by all its endpoints), or None if breakers are disabled."""
+        if not self.breaker_threshold:
+            return None
+        key = self.server_key(url)
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(threshold=self.breaker_threshold, reset_timeout=self.breaker_timeout)
+            return self.breakers[key]
+
+    def budget(self, url):
+        """Returns the RetryBudget of the url's endpoint (server and first two path segments, e.g. /v1/dataset)."""
+        parts = urlsplit(url)
+        key = f"{parts.scheme}://{parts.netloc}/" + '/'.join(parts.path.strip('/').split('/')[:2])
+        with self.lock:
+            if key not in self.budgets:
+                self.budgets[key] = RetryBudget()
+            return self.budgets[key]
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request through the pooled session for the url's server.
+        Accepts the same keyword arguments as `requests.request`.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if method.upper() == 'GET' and not kwargs.get('stream'):
+            if self.coalesce:
+                key = self.request_key(url, kwargs.get('params'), kwargs.get('headers'))
+                return self.single_flight(key, lambda: self.cached_get(url, **kwargs))
+            return self.cached_get(url, **kwargs)
+        return self.send(method, url, **kwargs)
+
+    @staticmethod
+    def request_key(url, params=None, headers=None):
+        """Identifies identical GETs: the full url (with query parameters) and the credentials sent."""
+        full_url = requests.Request('GET', url, params=params).prepare().url
+        return (full_url, (headers or {}).get('Authorization'))
+
+    def single_flight(self, key, send):
+        """
+        Call `send()` unless an identical request is already in flight, in which case wait for
+        it and return its response (or raise its error). Deduplicated calls are counted in `stats['coalesced']`.
+        """
+        with self.lock:
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = InFlight()
+            else:
+                self.stats['coalesced'] += 1
+        if not leader:
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.response
+        try:
+            call.response = send()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            call.event.set()
+        return call.response
+
+    def cached_get(self, url, **kwargs):
+        """
+        GET through the response cache, if one is configured. Cached entries are revalidated with
+        `If-None-Match`/`If-Modified-Since`, so unchanged resources cost a 304 (or nothing while
+        younger than the cache's `max_age`). Without a cache, GETs ask intermediaries not to serve stale copies.
+        """
+        headers = dict(kwargs.pop('headers', None) or {})
+        if self.cache is None:
+            headers.setdefault('Cache-Control', 'no-cache')
+            return self.send('GET', url, headers=headers, **kwargs)
+        full_url = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+        key = self.cache.key(full_url, headers)
+        entry = self.cache.get(key)
+        if entry and self.cache.is_fresh(entry):
+            self.cache.stats['hits'] += 1
+            return self.cache.response(entry)
+        if entry:
+            headers.update(self.cache.conditional_headers(entry))
+        r = self.send('GET', url, headers=headers, **kwargs)
+        if entry and r.status_code == 304:
+            self.cache.stats['revalidated'] += 1
+            self.cache.touch(key, entry)
+            return self.cache.response(entry)
+        self.cache.stats['misses'] += 1
+        self.cache.store(key, r)
+        return r
+
+    def send(self, method, url, **kwargs):
+        """
+        Send a request on the pooled session, without going through the response cache, retrying
+        transient failures according to the retry policy, the endpoint's retry budget and the
+        server's circuit breaker.
+        """
+        breaker = self.breaker(url)
+        budget = self.budget(url)
+        budget.deposit()
+        if breaker:
+            breaker.before(url)
+        attempt = 0
+        while True:
+            r, error = None, None
+            try:
+                r = self.send_once(method, url, **kwargs)
+            except requests.exceptions.RequestException as err:
+                error = err
+            except BaseException:
+                if breaker:
+                    breaker.release()
+                raise
+            retry = self.retry
+            if not retry or attempt >= retry.retries or not retry.should_retry(method, response=r, error=error):
+                break
+            delay = retry.delay(attempt, response=r)
+            if delay > retry.max_backoff or not budget.withdraw():
+                break
+            with self.lock:
+                self.stats['retries'] += 1
+            time.sleep(delay)
+            attempt += 1
+        # One outcome per request, once its retries are used up
+        if breaker:
+            breaker.record(ok=not breaker.is_failure(status=r.status_code if r is not None else None, error=error))
+        if error is not None:
+            raise error
+        return r
+
+    def send_once(self, method, url, **kwargs):
+        """Send a single request, bounded by the server's rate and concurrency limits."""
+        with self.lock:
+            self.stats['requests'] += 1
+        bucket, limiter = self.limiters(url)
+        if bucket:
+            bucket.acquire()
+        limiter.acquire()
+        start = time.monotonic()
+        try:
+            r = self.session(url).request(method, url, **kwargs)
+        except Exception:
+            limiter.release(ok=False)
+            raise
+        limiter.release(ok=r.status_code != 429 and r.status_code < 500, latency=time.monotonic() - start)
+        authorization = (kwargs.get('headers') or {}).get('Authorization')
+        if r.status_code == 401 and authorization:
+            from .user import invalidate_user
+            invalidate_user(token=authorization.split(' ')[-1])
+        return r
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.request('PATCH', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+transport = Transport()
+
+
+def configure(**kwargs):
+    """
+    Configure the package-wide transport, e.g. `Skydipper.transport.configure(pool_maxsize=50, timeout=30)`.
+    """
+    return transport.configure(**kwargs)
+
+
+def enable_cache(path=None, max_entries=1024, max_bytes=256 * 1024 * 1024, max_age=0):
+    """
+    Turn on the package-wide response cache, e.g. `Skydipper.transport.enable_cache('~/.Skydipper/http-cache')`.
+    See `Skydipper.cache.ResponseCache` for the parameters.
+    """
+    from .cache import ResponseCache
+    transport.cache = ResponseCache(path=path, max_entries=max_entries, max_bytes=max_bytes, max_age=max_age)
+    return transport.cache
@@ -1,93 +1,237 @@
-import requests
+from .transport import transport
 import json
 import random
 import os
+import sys
 import datetime
+import threading
+import time
+import base64
+
+TOKEN_TTL = 3600
+EXPIRY_MARGIN = 300
+
+
+def decode_token(token):
+    """
+    Returns the claims (e.g. `exp`, `iat`) of a JWT without verifying its signature,
+    or None if the token can not be decoded.
+    """
+    try:
+        payload = token.strip().split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except:
+        return None
 
 
 class User:
     """
     This is the main User class.
 
+    Credentials are resolved lazily, the first time an authenticated call needs them, from (in order)
+    the `token` argument, the SKYDIPPER_API_TOKEN environment variable, the `~/.Skydipper/creds` file,
+    or a login with SKYDIPPER_EMAIL/SKYDIPPER_PASSWORD (prompting for them only in an interactive session).
+
     Parameters
     ----------
-    id_hash: int
-        An ID hash of the dataset in the API.
-    attributes: dic
-        A dictionary holding the attributes of a dataset.
-    fname: str
-        A path/file string pointing to the location of a file for upload.
-    sever: str
-        A URL string of the vizzuality server.
+    token: str
+        An (optional) API token.
+    interactive: bool
+        Allow prompting for an email and password if no valid credentials are found.
+    ttl: int
+        Number of seconds a successful token validation is trusted for.
     """
 
-    def __init__(self):
+    def __init__(self, token=None, interactive=True, ttl=TOKEN_TTL):
         self.home = os.path.expanduser('~')
         self.hidden_folder_path = f"{self.home}/.Skydipper"
         self.hidden_creds_file_path = f"{self.hidden_folder_path}/creds"
-        try:
-            os.stat(self.hidden_folder_path) #<-- Does the .Skydipper credential folder exist?
-            #print(f"Hidden credential folder found at {self.hidden_folder_path}")
-        except:
-            os.mkdir(self.hidden_folder_path) # If not, create the folder in a users home dir
-            #print(f"No hidden folder - generating one at {self.hidden_folder_path}")
-        # At this point, a hidden folder definitley exists
-        # Now it's time to get some authorization data...
-        # First see if there is a credential file
-        if not os.path.exists(self.hidden_creds_file_path):
-            #print("No token file - Generating one now")
-            self.gen_token()
-        # At this point, there should be a cred file. Read the credential from the file and Test if it is valid
-        self.token = self.read_token()
-        if not self.token_valid():
-            self.gen_token()
-        #print(f"Authentication success: {self.token_valid()}")
-        self.headers =  {
-                        'Authorization': f'Bearer {self.token}',
-                        'Content-Type': 'application/json',
-                        'Cache-Control': 'no-cache'
-                        }
+        self.interactive = interactive
+        self.ttl = ttl
+        self._token = token or os.environ.get('SKYDIPPER_API_TOKEN')
+        self.validated_at = None
+        self.rejected = False
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return f"User {'authenticated' if self.validated_at else 'anonymous'}"
+
+    @property
+    def token(self):
+        """The API token, resolved and validated on first access."""
+        self.authenticate()
+        return self._token
+
+    @token.setter
+    def token(self, value):
+        self._token = value
+
+    @property
+    def headers(self):
+        """Headers for authenticated (write) requests."""
+        return {
+            'Authorization': f'Bearer {self.token}',
+            'Content-Type': 'application/json'
+            }
+
+    @property
+    def read_headers(self):
+        """
+        Headers for read-only requests. Never triggers authentication: a token is only sent
+        if one was given explicitly or has already been resolved.
+        """
+        if self._token:
+            return {'Authorization': f'Bearer {self._token}', 'Content-Type': 'application/json'}
+        return {'Content-Type': 'application/json'}
+
+    def authenticate(self):
+        """
+        Resolve and validate credentials. Raises a ValueError if none are available
+        and the session is not interactive.
+        """
+        with self.lock:
+            if not self._token and os.path.exists(self.hidden_creds_file_path):
+                self._token = self.read_token()
+            if self._token:
+                self.refresh(ttl=self.ttl)
+            else:
+                self.gen_token()
+                if self._token:
+                    self.validated_at = time.monotonic()
+            if not self._token:
+                raise ValueError('No valid Skydipper credentials. Pass a token, set SKYDIPPER_API_TOKEN, '
+                                 'or set SKYDIPPER_EMAIL and SKYDIPPER_PASSWORD.')
+            return self
+
+    def has_credentials(self):
+        """
+        Whether valid credentials are available (a token, the creds file or SKYDIPPER_EMAIL and
+        SKYDIPPER_PASSWORD), without prompting for them or raising if there are none.
+        """
+        with self.lock:
+            interactive, self.interactive = self.interactive, False
+            try:
+                self.authenticate()
+                return True
+            except ValueError:
+                return False
+            finally:
+                self.interactive = interactive
 
     def gen_token(self):
         """
             Use the authorization endpoint to go to https://api.skydipper.com/auth
         """
-        email = input("Please enter your the email address associated with your Skydipper account")
-        password = input("Please enter your Skydipper password")
+        email = os.environ.get('SKYDIPPER_EMAIL')
+        password = os.environ.get('SKYDIPPER_PASSWORD')
+        if not (email and password):
+            if not (self.interactive and sys.stdin and sys.stdin.isatty()):
+                self._token = None
+                return
+            email = input("Please enter your the email address associated with your Skydipper account")
+            password = input("Please enter your Skydipper password")
         payload = {
             "email": email,
             "password": password
         }
         url = 'https://api.skydipper.com/auth/login'
         headers = {'Content-Type': 'application/json'}
-        r = requests.post(url, json=payload, headers=headers)
+        r = transport.post(url, json=payload, headers=headers)
         if r.status_code == 200:
             self.user_id = r.json().get('data').get('id')
             self.createdAt = r.json().get('data').get('createdAt')
             self.role = r.json().get('data').get('role')
             self.extraUserData = r.json().get('data').get('extraUserData')
-            self.token = r.json().get('data').get('token')
+            self._token = r.json().get('data').get('token')
+            self.rejected = False
             self.save_creds()
+        else:
+            self._token = None
         return
 
     def save_creds(self):
+        if not os.path.isdir(self.hidden_folder_path):
+            os.mkdir(self.hidden_folder_path)
         with open(self.hidden_creds_file_path, 'w') as opened_file:
-            opened_file.write(self.token)
+            opened_file.write(self._token)
 
     def read_token(self):
         """Read the token from the creds file"""
         with open(self.hidden_creds_file_path, 'r') as opened_file:
             tmp = opened_file.readlines()[0]
-        return tmp
+        return tmp.strip()
 
-    def token_valid(self):
+    def token_valid(self, check_local=True):
+        """
+        Check the token is valid. The `exp` claim of the JWT is checked locally first, so the
+        network is only used when the token is close to expiry, carries no expiry, or was
+        rejected by the server (see `invalidate`).
+        """
+        claims = decode_token(self._token) if check_local and not self.rejected else None
+        expires = claims.get('exp') if isinstance(claims, dict) else None
+        if isinstance(expires, (int, float)):
+            if expires - time.time() > EXPIRY_MARGIN:
+                self.validated_at = time.monotonic()
+                return True
+            if expires <= time.time():
+                self.validated_at = None
+                return False
         url = "https://api.skydipper.com/api/v1/microservice"
         headers = {
-            'Authorization': f'Bearer {self.token}',
+            'Authorization': f'Bearer {self._token}',
             'Content-Type': 'application/json'
         }
-        r = requests.get(url, headers=headers)
+        r = transport.get(url, headers=headers)
+        self.rejected = False
         if r.status_code == 200:
+            self.validated_at = time.monotonic()
             return True
         else:
+            self.validated_at = None
             return False
+
+    def refresh(self, ttl=TOKEN_TTL):
+        """
+        Re-validate the token if the last successful validation is older than `ttl` seconds,
+        generating a new one if it is no longer accepted.
+        """
+        if self.validated_at and time.monotonic() - self.validated_at < ttl:
+            return self
+        if not self.token_valid():
+            self.gen_token()
+            if self._token:
+                self.validated_at = time.monotonic()
+        return self
+
+    def invalidate(self):
+        """
+        Mark the token as rejected by the server, so the next refresh validates it over the network.
+        """
+        self.validated_at = None
+        self.rejected = True
+
+
+_users = {}
+_user_lock = threading.Lock()
+
+
+def get_user(token=None, ttl=TOKEN_TTL):
+    """
+    Returns the process-wide User shared by every entity (or by every entity given the same explicit `token`).
+
+    The User is created on first call without touching the network; credentials are only
+    resolved and validated (at most once every `ttl` seconds) when a write operation needs them.
+    """
+    with _user_lock:
+        user = _users.get(token)
+        if user is None:
+            user = _users[token] = User(token=token, ttl=ttl)
+        return user
+
+
+def invalidate_user(token=None):
+    """Called by the transport when the server answers 401 to a request authenticated with `token`."""
+    for user in list(_users.values()):
+        if token is None or user._token == token:
+            user.invalidate()
@@ -1,8 +1,11 @@
+import re
 import json
+import copy
 import math
-import ee
+import queue
+import threading
 from time import sleep
-from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor
 
 def html_box(item):
     """Returns an HTML block with template strings filled-in based on item attributes."""
@@ -174,6 +177,91 @@ def flatten_list(nested_list):
     else:
         return []
 
+def parallel_map(func, items, workers=16, return_exceptions=False):
+    """
+    Apply func to every item using a pool of threads, returning the results in the order of items.
+
+    Requests are still bounded per server by the transport's rate and adaptive concurrency limits,
+    so `workers` only caps how many calls may wait on them. With `return_exceptions=True` a failing
+    call puts its exception in the results instead of raising it.
+    """
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items)))) as pool:
+        futures = [pool.submit(func, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as err:
+                if not return_exceptions:
+                    raise
+                results.append(err)
+    return results
+
+
+def prefetched(iterable, size=1):
+    """
+    Iterate over `iterable` from a background thread, keeping up to `size` items ready ahead of the consumer.
+    Errors raised by the iterable are re-raised to the consumer; stopping early stops the thread.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as err:
+            put((done, err))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class BatchResult(list):
+    """
+    Entities returned by a bulk loader, in the order of the requested ids. Ids that failed to load
+    hold None, and their errors are collected in `errors` (a dictionary of id: exception).
+    """
+    def __init__(self, items=(), errors=None):
+        super().__init__(items)
+        self.errors = errors or {}
+
+
+def load_batch(ids, load, workers=16, keys=None):
+    """
+    Call `load(id)` for every id with a bounded thread pool, collecting the results in a BatchResult.
+    Errors are keyed by id, or by the matching entry of `keys` if given.
+    """
+    ids = list(ids)
+    results = parallel_map(load, ids, workers=workers, return_exceptions=True)
+    errors = {k: r for k, r in zip(keys if keys is not None else ids, results) if isinstance(r, Exception)}
+    return BatchResult([None if isinstance(r, Exception) else r for r in results], errors)
+
+
 def get_geojson_string(geom):
     coords = geom.get('coordinates', None)
     if coords and not any(isinstance(i, list) for i in coords[0]):
@@ -250,6 +338,224 @@ def nested_set(dic, keys, value):
         dic = dic.setdefault(key, {})
     dic[keys[-1]] = value
 
+def split_limit(sql):
+    """
+    Split a trailing `LIMIT n [OFFSET m]` off a SQL query, returning (sql, limit or None, offset).
+    """
+    sql = sql.strip().rstrip(';').strip()
+    match = re.search(r'\s+limit\s+(\d+)(?:\s+offset\s+(\d+))?$', sql, flags=re.I)
+    if not match:
+        return sql, None, 0
+    return sql[:match.start()], int(match.group(1)), int(match.group(2) or 0)
+
+WKB_HEX = re.compile(r'^0[01][0-9a-fA-F]{8,}$')
+WKT = re.compile(r'^\s*(POINT|LINESTRING|POLYGON|MULTIPOINT|MULTILINESTRING|MULTIPOLYGON|GEOMETRYCOLLECTION)\b', flags=re.I)
+
+def geometry_format(value):
+    """
+    The encoding of a geometry value returned by a query: 'wkb' (hex, e.g. the_geom), 'geojson'
+    (e.g. ST_AsGeoJSON), 'wkt' (e.g. ST_AsText), or None if it is not a geometry.
+    """
+    if isinstance(value, dict):
+        return 'geojson' if 'type' in value and ('coordinates' in value or 'geometries' in value) else None
+    if not isinstance(value, str):
+        return None
+    if WKB_HEX.match(value) and len(value) % 2 == 0:
+        return 'wkb'
+    if value.lstrip().startswith('{') and '"type"' in value and ('"coordinates"' in value or '"geometries"' in value):
+        return 'geojson'
+    if WKT.match(value):
+        return 'wkt'
+    return None
+
+def decode_geometries(frame):
+    """
+    Decode the geometry columns of a query result in bulk with the shapely array functions,
+    and make them GeoSeries: `the_geom` (else the first geometry column) becomes the active geometry.
+
+    Columns are recognised from their first non-null value, and only converted if all their values decode
+    (a text column starting with e.g. 'POINT (1 2)' is left as it is). The CRS is read from the SRID of EWKB
+    values, otherwise it is EPSG:4326 (EPSG:3857 for `the_geom_webmercator`).
+    """
+    import json
+    import shapely
+    import geopandas as gpd
+    decoded = []
+    for name in frame.columns:
+        column = frame[name]
+        if column.dtype != object and not str(column.dtype).startswith(('str', 'string')):
+            continue
+        sample = column.dropna()
+        kind = geometry_format(sample.iloc[0]) if len(sample) else None
+        if not kind:
+            continue
+        values = column.astype(object).where(column.notna(), None).to_numpy()
+        if kind == 'wkb':
+            geoms = shapely.from_wkb(values, on_invalid='ignore')
+        elif kind == 'wkt':
+            geoms = shapely.from_wkt(values, on_invalid='ignore')
+        else:
+            if isinstance(sample.iloc[0], dict):
+                values = [None if v is None else json.dumps(v) for v in values]
+            geoms = shapely.from_geojson(values, on_invalid='ignore')
+        missing = shapely.is_missing(geoms)
+        if missing.sum() != column.isna().sum():
+            continue
+        srid = int(shapely.get_srid(geoms[~missing][0]))
+        crs = srid or (3857 if 'webmercator' in str(name) else 4326)
+        frame[name] = gpd.GeoSeries(geoms, index=frame.index, crs=f'EPSG:{crs}')
+        decoded.append(name)
+    if not decoded:
+        return frame
+    return gpd.GeoDataFrame(frame).set_geometry('the_geom' if 'the_geom' in decoded else decoded[0])
+
+def arrow_available(columnar=None):
+    """
+    Whether query results should be decoded through pyarrow: `columnar` if set
+    (raising if pyarrow is missing), otherwise whenever pyarrow is installed.
+    """
+    import importlib.util
+    available = importlib.util.find_spec('pyarrow') is not None
+    if columnar and not available:
+        raise ImportError('Columnar query results require pyarrow: pip install Skydipper[arrow]')
+    return available if columnar is None else bool(columnar)
+
+def nullable_dtypes():
+    """
+    Maps Arrow integer, boolean and string types to the pandas nullable dtypes, so columns with
+    nulls keep their type (instead of integers becoming float64 and booleans object).
+    """
+    import pyarrow as pa
+    import pandas as pd
+    dtypes = {pa.bool_(): pd.BooleanDtype(), pa.string(): pd.StringDtype(), pa.large_string(): pd.StringDtype()}
+    for bits in [8, 16, 32, 64]:
+        dtypes[getattr(pa, f'int{bits}')()] = getattr(pd, f'Int{bits}Dtype')()
+        dtypes[getattr(pa, f'uint{bits}')()] = getattr(pd, f'UInt{bits}Dtype')()
+    return dtypes
+
+def table_to_frame(table, decode_geometry=True):
+    """
+    Returns a GeoDataFrame from a pyarrow Table, releasing the Arrow buffers column by column
+    as they are converted so the table and the frame are not both held in memory.
+    Integer, boolean and string columns become pandas nullable dtypes (see `nullable_dtypes`).
+    """
+    import geopandas as gpd
+    dtypes = nullable_dtypes()
+    frame = gpd.GeoDataFrame(table.to_pandas(split_blocks=True, self_destruct=True, types_mapper=dtypes.get))
+    return decode_geometries(frame) if decode_geometry else frame
+
+def rows_to_frame(rows, columnar=None, decode_geometry=True):
+    """
+    Returns a GeoDataFrame from query rows (a list of dictionaries), with its geometry columns decoded.
+
+    With pyarrow, the rows are decoded into typed columnar arrays (integers with nulls, floats, booleans,
+    strings...) before the conversion to pandas, instead of pandas inferring object columns cell by cell;
+    integers, booleans and strings keep their nulls as pandas nullable dtypes (Int64, boolean, string).
+    Rows Arrow cannot type (e.g. a column mixing numbers and strings) fall back to the plain conversion,
+    unless `columnar` is True.
+
+    Parameters
+    ----------
+    rows: list
+        The rows of a query.
+    columnar: bool
+        Decode through pyarrow; by default whenever it is installed.
+    decode_geometry: bool
+        Decode geometry columns (see `decode_geometries`).
+    """
+    import geopandas as gpd
+    if not rows or not arrow_available(columnar):
+        frame = gpd.GeoDataFrame(rows or None)
+        return decode_geometries(frame) if decode_geometry else frame
+    import pyarrow as pa
+    # Every key of every row becomes a column (from_pylist would only keep the keys of the first row)
+    names = list(dict.fromkeys(key for row in rows for key in row))
+    try:
+        table = pa.Table.from_pydict({name: [row.get(name) for row in rows] for name in names})
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if columnar:
+            raise
+        frame = gpd.GeoDataFrame(rows)
+        return decode_geometries(frame) if decode_geometry else frame
+    return table_to_frame(table, decode_geometry=decode_geometry)
+
+def csv_to_frame(content, decode_geometry=True):
+    """
+    Returns a GeoDataFrame from a CSV export (bytes), parsed straight into Arrow columns.
+    """
+    import io
+    import pyarrow.csv
+    return table_to_frame(pyarrow.csv.read_csv(io.BytesIO(content)), decode_geometry=decode_geometry)
+
+def has_order_by(sql):
+    """
+    Whether a SQL query ends with its own ORDER BY clause (ignoring ORDER BY inside subqueries or windows).
+    """
+    top_level = sql
+    while re.search(r'\([^()]*\)', top_level):
+        top_level = re.sub(r'\([^()]*\)', '', top_level)
+    return re.search(r'\border\s+by\b', top_level, flags=re.I) is not None
+
+def diff(old, new, path=''):
+    """
+    Structural difference between two JSON documents, as a dictionary of dotted path: [old value, new value].
+    Dictionaries are compared key by key, other values (including lists) as a whole.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = {}
+        for key in list(old) + [k for k in new if k not in old]:
+            changes.update(diff(old.get(key), new.get(key), f'{path}.{key}' if path else key))
+        return changes
+    if old != new:
+        return {path: [old, new]}
+    return {}
+
+def set_path(container, path, value):
+    """
+    Set the value at a dotted `path` inside nested dictionaries and lists (e.g. 'layerConfig.body.layers.0.id').
+    Path segments inside lists must be existing indices; missing (or None) dictionary values are created,
+    but a value that is neither a dictionary nor a list is never replaced by one: a ValueError is raised.
+    """
+    keys = path.split('.')
+    for n, key in enumerate(keys):
+        last = n == len(keys) - 1
+        if isinstance(container, list):
+            try:
+                index = int(key)
+                container[index]
+            except (ValueError, IndexError):
+                raise ValueError(f"Cannot set '{path}': '{key}' is not an index of the list at '{'.'.join(keys[:n])}'.")
+            if last:
+                container[index] = value
+            else:
+                container = container[index]
+        elif isinstance(container, dict):
+            if last:
+                container[key] = value
+            else:
+                if container.get(key) is None:
+                    container[key] = {}
+                container = container[key]
+        else:
+            raise ValueError(f"Cannot set '{path}': the value at '{'.'.join(keys[:n])}' is not a dictionary or a list.")
+
+def update_payload(attributes, update_params, keys):
+    """
+    The minimal PATCH body applying `update_params` ({key or dotted.path: value}) to `attributes`.
+
+    The API replaces top-level values as a whole, so a change deep inside e.g. `layerConfig` sends
+    the updated `layerConfig`, but top-level values (among `keys`) that do not change are left out.
+    Dotted paths go through lists by index (see `set_path`). An empty dictionary means the update
+    changes nothing. `attributes` is not modified.
+    """
+    top_keys = {k.split('.')[0] for k in update_params if k.split('.')[0] in keys}
+    updated = {k: copy.deepcopy(attributes.get(k)) for k in top_keys}
+    for k, v in update_params.items():
+        if k.split('.')[0] not in updated:
+            continue
+        set_path(updated, k, v)
+    return {k: v for k, v in updated.items() if diff(attributes.get(k), v)}
+
 def server_uses_widgets(server):
     """
     Does the server currently set use Widget objects? Response gives True if it does, false if not.
@@ -260,6 +566,19 @@ def server_uses_widgets(server):
     else:
         return False
 
+def dataset_includes(server, defer_children=False):
+    """
+    Comma separated child entities embedded with a dataset (its `includes=` parameter) on a server.
+    With `defer_children=True` layers and widgets are left out.
+    """
+    if server_uses_widgets(server):
+        includes = ['layer', 'widget', 'vocabulary', 'metadata']
+    else:
+        includes = ['layer', 'metadata']
+    if defer_children:
+        includes = [i for i in includes if i not in ['layer', 'widget']]
+    return ','.join(includes)
+
 def tile_url(image, viz_params=None):
     """Create a target url for tiles from an EE image asset.
     e.g.
@@ -286,6 +605,7 @@ class EE_TILE_CALCS(object):
     a given geom, at a specified z-level.
     """
     def __init__(self, tileSize=256):
+        import ee
         ee.Initialize()
         self.tileSize = tileSize
         self.equatorial_circumference = 40075016.686
@@ -326,6 +646,7 @@ class EE_TILE_CALCS(object):
         return [lon, lat]
 
     def getTilesForGeometry(self, geometry, zoom):
+        import ee
         bounds = ee.List(geometry.bounds().coordinates().get(0))
         ll = bounds.get(0).getInfo() # <-- Look at making this happen server-side
         ur = bounds.get(2).getInfo() # <-- Look at making this happen server-side
@@ -341,6 +662,7 @@ class EE_TILE_CALCS(object):
 
     def getTilesList(self, geometry, zoom):
         """Returns a list of individual features, where each feature element is a tile footprint."""
+        import ee
         bounds = ee.List(geometry.bounds().coordinates().get(0))
         ll = bounds.get(0).getInfo() # <-- Look at making this happen server-side
         ur = bounds.get(2).getInfo() # <-- Look at making this happen server-side
@@ -400,6 +722,8 @@ class MovieMaker(object):
     """
     def __init__(self, privatekey_path, bucket_name, folder_path,
                     area=None, zlist=None, ic=None, report_status=False):
+        import ee
+        from google.cloud import storage
         self.storage_client = storage.Client.from_service_account_json(privatekey_path)
         self.privatekey_path = privatekey_path
         self.bucket = self.storage_client.get_bucket(bucket_name)
@@ -412,31 +736,50 @@ class MovieMaker(object):
         self.report_status = report_status
         ee.Initialize()
 
-    def run(self):
-        """Main worker method"""
+    def run(self, workers=4):
+        """
+        Main worker method. Export tasks are started from up to `workers` threads; the number actually
+        submitting at once adapts (AIMD), halving whenever Earth Engine refuses a task.
+        """
+        import ee
+        from .transport import AdaptiveLimiter, RetryPolicy
         assert type(self.zlist) == list, "the zlist must be a list to run, e.g. zlist=[2]"
         assert type(self.area) == ee.geometry.Geometry, "An area of type ee.geometry.Geometry must be provided to run"
+        limiter = AdaptiveLimiter(initial=1, maximum=workers, latency_target=60)
+        retry = RetryPolicy(retries=6, backoff=30, max_backoff=600)
+
+        def start(unprocessed):
+            z=unprocessed[0].split('/')[-3]
+            x=unprocessed[0].split('/')[-2]
+            y=unprocessed[0].split('/')[-1].split('.mp4')[0]
+            if self.report_status: print(f'{z}/{x}/{y}')
+            for attempt in range(retry.retries + 1):
+                limiter.acquire()
+                try:
+                    self.movie_maker(tile=unprocessed[1].get('tile'), z=z, x=x, y=y)
+                except (ee.EEException) as err:
+                    # Usually too many tasks queued: back off (jittered, exponential) before assigning it again
+                    limiter.release(ok=False)
+                    if attempt == retry.retries:
+                        raise
+                    sleep(retry.delay(attempt))
+                else:
+                    limiter.release(ok=True)
+                    return
+
         for zlevel in self.zlist:
             print(f"🧨 Calculating Z-level {zlevel}")
             tileset = self.tiler.getTilesList(self.area, zlevel)
             d = self.initial_dic_creation(tileset=tileset) # Starting dic of whatever has been burned to the bucket
             to_do = self.get_items_by_state(d, 'WAITING')
-            for unprocessed in to_do:
-                z=unprocessed[0].split('/')[-3]
-                x=unprocessed[0].split('/')[-2]
-                y=unprocessed[0].split('/')[-1].split('.mp4')[0]
-                if self.report_status: print(f'{z}/{x}/{y}')
-                try:
-                    self.movie_maker(tile=unprocessed[1].get('tile'), z=z, x=x, y=y)
-                except (ee.EEException) as err:
-                    sleep(60 * 5)  # Simple - Wait 5 mins and try assigning tasks again (this assumes the only issue )
-                    self.movie_maker(tile=unprocessed[1].get('tile'), z=z, x=x, y=y)
+            parallel_map(start, to_do, workers=workers)
         print("Program ended normally. Note that after the files have been generated you should run MovieMaker().reNamer()")
         self.reNamer()
         return
 
     def movie_maker(self, tile, z, x, y):
         """Generates a single movie tile"""
+        import ee
         g = tile.geometry()
         filtered = self.ic.filterBounds(g)
         #print(f"🗺 Exporting movie-tile to {self.bucket_name}/{self.folder_path}/{z}/{x}/{y}.mp4")
@@ -485,6 +828,7 @@ class MovieMaker(object):
 
     def get_current_status(self):
         """Consult the current EE Task list to see what's what"""
+        import ee
         batch_jobs = ee.batch.Task.list()
         processing_list = []
         processing_status = []
@@ -18,9 +18,11 @@ setuptools.setup(
                         'google-cloud-storage',
                         'earthengine-api==0.1.215',
                         'geopandas>=0.4.1',
+                        'shapely>=2.0',
                         'geojson>=2.4.0',
                         'pypng>=0.0.19',
                         'tqdm==4.41.1'],
+    extras_require={'async': ['aiohttp>=3.6'], 'arrow': ['pyarrow>=4.0']},
     packages=['Skydipper'],
     classifiers=[
         "Programming Language :: Python :: 3",
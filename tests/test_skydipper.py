@@ -2,6 +2,8 @@ import pytest
 import random
 import os
 import os.path
+import json
+import contextlib
 from Skydipper import Dataset, Collection, Layer, Metadata, Vocabulary, Widget, Image, ImageCollection, Geometry, utils
 
 try:
@@ -9,6 +11,47 @@ try:
 except:
     raise ValueError(f"Failed to access keys for test.")
 
+#----- Test helpers -----#
+
+def encode(body):
+    """A response body: bytes as they are, anything else as JSON."""
+    return body if isinstance(body, bytes) else json.dumps(body).encode()
+
+def fake_response(body=b'', status_code=200, headers=None):
+    """A requests.Response with the given body, to return from a faked transport method."""
+    import requests
+    r = requests.Response()
+    r.status_code = status_code
+    r.headers.update(headers or {})
+    r._content = encode(body)
+    return r
+
+@contextlib.contextmanager
+def serve(respond):
+    """
+    Serve GET requests on a local port, answered by `respond(request)` returning (status, body, headers)
+    from the request handler. Yields the base URL of the server.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, body, headers = respond(self)
+            body = encode(body)
+            self.send_response(status)
+            for k, v in {**headers, 'Content-Length': str(len(body))}.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+
 
 ### Collection Tests
 
@@ -258,3 +301,633 @@ def test_sld_functions():
     sld_str = utils.sldDump(sld_obj)
     assert sld_str == '<RasterSymbolizer> <ColorMap type="ramp" extended="false"> <ColorMapEntry color="#F8EBFF" quantity="-40" /> + <ColorMapEntry color="#ECCAFC" quantity="-20.667" /> + <ColorMapEntry color="#DFA4FF" quantity="-14.667" /> + <ColorMapEntry color="#C26DFE" quantity="-10" /> + <ColorMapEntry color="#9D36F7" quantity="-3.333" /> + <ColorMapEntry color="#6D00E1" quantity="-0.667" /> + <ColorMapEntry color="#3C00AB" /> + </ColorMap> </RasterSymbolizer>'
     assert utils.sldParse(sld_str) == test_sld
+
+#----- Transport Tests -----#
+
+def test_transport_pools_sessions_per_server():
+    from Skydipper.transport import Transport
+    t = Transport(pool_maxsize=5)
+    s1 = t.session('https://api.skydipper.com/v1/dataset/1')
+    s2 = t.session('https://api.skydipper.com/v1/layer/2')
+    s3 = t.session('https://api.resourcewatch.org/v1/dataset/1')
+    assert s1 is s2
+    assert s1 is not s3
+    t.close()
+    assert len(t.sessions) == 0
+
+#----- User Tests -----#
+
+def test_get_user_is_shared(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from Skydipper import user
+    created = []
+    class FakeUser:
+        def __init__(self, token=None, ttl=None):
+            created.append(self)
+    monkeypatch.setattr(user, 'User', FakeUser)
+    monkeypatch.setattr(user, '_users', {})
+    with ThreadPoolExecutor(8) as pool:
+        users = list(pool.map(lambda _: user.get_user(), range(32)))
+    assert len(created) == 1
+    assert all(u is created[0] for u in users)
+
+def test_token_valid_checks_jwt_expiry_locally(monkeypatch):
+    import base64, time
+    from Skydipper import user
+    def jwt(claims):
+        body = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+        return f"e30.{body}.signature"
+    def no_network(*args, **kwargs):
+        raise AssertionError('token_valid should not hit the network')
+    monkeypatch.setattr(user.transport, 'get', no_network)
+    u = user.User(token=jwt({'id': 'abc', 'exp': time.time() + 3600}))
+    assert user.decode_token(u.token)['id'] == 'abc'
+    assert u.token_valid() is True
+    u.token = jwt({'id': 'abc', 'exp': time.time() - 10})
+    assert u.token_valid() is False
+    assert user.decode_token('not-a-jwt') is None
+
+def test_user_is_lazy_and_non_interactive(monkeypatch, tmp_path):
+    from Skydipper import user
+    def no_network(*args, **kwargs):
+        raise AssertionError('anonymous reads should not hit the network')
+    monkeypatch.setattr(user.transport, 'get', no_network)
+    monkeypatch.delenv('SKYDIPPER_API_TOKEN', raising=False)
+    monkeypatch.delenv('SKYDIPPER_EMAIL', raising=False)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    u = user.User(interactive=False)
+    assert 'Authorization' not in u.read_headers
+    with pytest.raises(ValueError):
+        u.token
+    monkeypatch.setenv('SKYDIPPER_API_TOKEN', 'abc')
+    assert user.User().read_headers['Authorization'] == 'Bearer abc'
+
+def test_anonymous_layer_from_attributes_is_loaded(monkeypatch, tmp_path):
+    from Skydipper import user
+    from Skydipper.transport import transport
+    monkeypatch.delenv('SKYDIPPER_API_TOKEN', raising=False)
+    monkeypatch.delenv('SKYDIPPER_EMAIL', raising=False)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(user, '_users', {})
+    def fake_get(url, params=None, **kwargs):
+        return fake_response({'data': {'id': 'l1', 'attributes': {'name': 'a layer'}}})
+    monkeypatch.setattr(transport, 'get', fake_get)
+    assert not user.get_user().has_credentials()
+    layer = Layer(attributes={'id': 'l1'})
+    assert layer.id == 'l1' and layer.attributes == {'name': 'a layer'}
+
+#----- Import Tests -----#
+
+def test_import_does_not_load_heavy_dependencies():
+    import subprocess, sys
+    code = ("import sys; "
+            "from Skydipper import Dataset, Layer, Collection, Geometry, ImageCollection, Widget; "
+            "print(','.join(m for m in ('geopandas', 'folium', 'ee', 'shapely', 'numpy', 'png', 'google.cloud', 'google.cloud.storage') if m in sys.modules))")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert out == '\n'
+
+def test_manifest_import_has_no_side_effects():
+    import subprocess, sys
+    code = "import sys, Skydipper.manifest; print('python_jsonschema_objects' in sys.modules)"
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert out == 'False\n'
+    from Skydipper import manifest
+    assert manifest.manifest_classes() is manifest.manifest_classes()
+    assert manifest.create_timestamp("2018-08-13T14:14:03").serialize() == '{"seconds": 1534169643}'
+
+#----- Cache Tests -----#
+
+def test_response_cache_revalidates_with_etag(tmp_path):
+    from Skydipper.transport import Transport
+    from Skydipper.cache import ResponseCache
+    calls = []
+    def respond(request):
+        calls.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return 304, b'', {}
+        return 200, {'data': {'id': '1'}}, {'ETag': '"v1"'}
+    with serve(respond) as base:
+        url = f'{base}/v1/layer/1'
+        t = Transport(cache=ResponseCache(path=str(tmp_path)))
+        assert t.get(url).json()['data']['id'] == '1'
+        r = t.get(url)
+        assert r.status_code == 200 and r.from_cache and r.json()['data']['id'] == '1'
+        assert calls == [None, '"v1"']
+        # A new process-level cache reads the entry back from disk
+        t2 = Transport(cache=ResponseCache(path=str(tmp_path), max_age=60))
+        assert t2.get(url).json()['data']['id'] == '1'
+        assert len(calls) == 2
+
+def test_response_cache_memory_is_bounded_by_size():
+    from Skydipper.cache import ResponseCache
+    cache = ResponseCache(max_bytes=250)
+    def response(size):
+        return fake_response(b'x' * size, headers={'ETag': '"v1"'})
+    for n in range(3):
+        cache.store(f'k{n}', response(100))
+    assert list(cache.entries) == ['k1', 'k2'] and cache.memory_bytes == 200
+    cache.store('big', response(300))
+    assert cache.get('big') is None and cache.memory_bytes == 200
+    cache.store('k2', response(50))
+    assert cache.memory_bytes == 150
+
+def test_transport_coalesces_concurrent_gets(monkeypatch):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from Skydipper.transport import Transport
+    t = Transport()
+    sent = []
+    def slow_send(method, url, **kwargs):
+        sent.append(url)
+        time.sleep(0.2)
+        return f'response {url}'
+    monkeypatch.setattr(t, 'send', slow_send)
+    urls = ['https://api.skydipper.com/v1/layer/1'] * 8 + ['https://api.skydipper.com/v2/geostore/2'] * 4
+    with ThreadPoolExecutor(12) as pool:
+        responses = list(pool.map(t.get, urls))
+    assert responses == [f'response {url}' for url in urls]
+    assert len(sent) == 2
+    assert t.stats['coalesced'] == 10
+
+def test_adaptive_limiter_backs_off_and_recovers():
+    from Skydipper.transport import AdaptiveLimiter
+    limiter = AdaptiveLimiter(initial=8, maximum=16, cooldown=0)
+    limiter.acquire()
+    limiter.release(ok=False)
+    assert int(limiter.limit) == 4
+    for _ in range(40):
+        limiter.acquire()
+        limiter.release(ok=True, latency=0.1)
+    assert 8 <= limiter.limit <= 16
+    limiter.acquire()
+    limiter.release(ok=True, latency=60)
+    assert limiter.limit < 8
+    assert utils.parallel_map(lambda x: x * 2, range(10), workers=4) == [x * 2 for x in range(10)]
+
+def test_transport_retries_then_opens_circuit(monkeypatch):
+    from Skydipper.transport import Transport, RetryPolicy, CircuitOpenError
+    t = Transport(retry=RetryPolicy(retries=2, backoff=0), breaker_threshold=3, breaker_timeout=60)
+    statuses = [503, 503, 200]
+    def fake_send_once(method, url, **kwargs):
+        return fake_response(status_code=statuses.pop(0) if statuses else 503)
+    monkeypatch.setattr(t, 'send_once', fake_send_once)
+    assert t.send('GET', 'https://api.skydipper.com/v1/layer/1').status_code == 200
+    assert t.stats['retries'] == 2
+    # POSTs are not retried on 5xx
+    assert t.send('POST', 'https://api.skydipper.com/v1/layer').status_code == 503
+    # Each request counts once, however many times it was retried
+    assert t.send('GET', 'https://api.skydipper.com/v1/layer/1').status_code == 503
+    assert t.breaker('https://api.skydipper.com').failures == 2
+    assert t.send('GET', 'https://api.skydipper.com/v1/layer/1').status_code == 503
+    with pytest.raises(CircuitOpenError):
+        t.send('GET', 'https://api.skydipper.com/v1/dataset/1')
+    # A 500 from one failing entity does not open the circuit for the server
+    t = Transport(retry=RetryPolicy(retries=4, backoff=0), breaker_threshold=2, breaker_timeout=60)
+    def failing_entity(method, url, **kwargs):
+        return fake_response(status_code=500 if 'bad' in url else 200)
+    monkeypatch.setattr(t, 'send_once', failing_entity)
+    for _ in range(3):
+        assert t.send('GET', 'https://api.skydipper.com/v1/geostore/bad').status_code == 500
+    assert t.send('GET', 'https://api.skydipper.com/v1/dataset/good').status_code == 200
+
+def test_circuit_trial_released_on_unexpected_error(monkeypatch):
+    from Skydipper.transport import Transport, CircuitOpenError
+    t = Transport(retry=False, breaker_threshold=1, breaker_timeout=60)
+    breaker = t.breaker('https://api.skydipper.com/v1/layer/1')
+    breaker.record(ok=False)
+    breaker.opened_at -= 61
+    def broken_send_once(method, url, **kwargs):
+        raise KeyError('unexpected')
+    monkeypatch.setattr(t, 'send_once', broken_send_once)
+    with pytest.raises(KeyError):
+        t.send('GET', 'https://api.skydipper.com/v1/layer/1')
+    assert breaker.state == 'half-open' and not breaker.trial
+    breaker.before('https://api.skydipper.com/v1/layer/1')
+    with pytest.raises(CircuitOpenError):
+        breaker.before('https://api.skydipper.com/v1/layer/1')
+    breaker.trial_at -= 61
+    breaker.before('https://api.skydipper.com/v1/layer/1')
+
+#----- Async Tests -----#
+
+def test_async_dataset_load_builds_children_from_includes():
+    import asyncio
+    pytest.importorskip('aiohttp')
+    from Skydipper import aio
+    paths = []
+    def respond(request):
+        paths.append(request.path)
+        ds_id = request.path.split('/')[3].split('?')[0]
+        layer = {'id': f'{ds_id}-layer', 'type': 'layer', 'attributes': {'name': 'a layer', 'dataset': ds_id}}
+        return 200, {'data': {'id': ds_id, 'type': 'dataset',
+                              'attributes': {'name': f'dataset {ds_id}', 'layer': [layer], 'metadata': []}}}, {}
+    async def load_all(base):
+        try:
+            return await asyncio.gather(*[aio.AsyncDataset.load(str(i), server=base) for i in range(5)])
+        finally:
+            await aio.close()
+    with serve(respond) as base:
+        datasets = asyncio.run(load_all(base))
+    assert [ds.id for ds in datasets] == ['0', '1', '2', '3', '4']
+    assert datasets[2].layers[0].id == '2-layer' and datasets[2].layers[0].attributes['name'] == 'a layer'
+    assert 'layer' not in datasets[2].attributes
+    assert len(paths) == 5
+    assert aio.client._session is None
+
+def test_async_client_uses_transport_limits_and_breaker(monkeypatch):
+    import asyncio
+    pytest.importorskip('aiohttp')
+    from Skydipper import aio
+    from Skydipper.transport import transport, RetryPolicy, CircuitOpenError
+    monkeypatch.setattr(transport, 'retry', RetryPolicy(retries=1, backoff=0))
+    monkeypatch.setattr(transport, 'breaker_threshold', 2)
+    requests_before = transport.stats['requests']
+    async def run(url):
+        async with aio.client:
+            assert await aio.client.get(url) == (503, None)
+            assert await aio.client.get(url) == (503, None)
+            with pytest.raises(CircuitOpenError):
+                await aio.client.get(url)
+    with serve(lambda request: (503, b'', {})) as base:
+        url = f'{base}/v1/dataset/1'
+        asyncio.run(run(url))
+    assert transport.stats['requests'] - requests_before == 4
+    assert transport.limiters(url)[1].active == 0 and aio.client._session is None
+
+def test_dataset_children_built_from_includes(monkeypatch):
+    from Skydipper.transport import transport
+    urls = []
+    def fake_get(url, params=None, **kwargs):
+        urls.append(url)
+        layers = [{'id': f'layer-{i}', 'type': 'layer', 'attributes': {'name': f'layer {i}'}} for i in range(30)]
+        attributes = {'name': 'a dataset', 'metadata': []}
+        if 'layer' in url.split('includes=')[-1]:
+            attributes['layer'] = layers
+        return fake_response({'data': {'id': 'ds', 'attributes': attributes}})
+    monkeypatch.setattr(transport, 'get', fake_get)
+    ds = Dataset('ds')
+    assert len(ds.layers) == 30 and ds.layers[29].attributes['name'] == 'layer 29'
+    assert len(urls) == 1
+    deferred = Dataset('ds', defer_children=True)
+    assert 'layer' not in urls[-1].split('includes=')[-1]
+    assert len(urls) == 2
+    assert [l.id for l in deferred.layers] == [l.id for l in ds.layers]
+    assert len(deferred.layers) == 30 and len(urls) == 3
+
+def test_dataset_from_ids_keeps_order_and_errors(monkeypatch):
+    from Skydipper.transport import transport
+    urls = []
+    def fake_get(url, params=None, **kwargs):
+        urls.append(url)
+        if params and 'ids' in params:
+            docs = [{'id': i, 'attributes': {'name': i}} for i in params['ids'].split(',') if i != 'c']
+            return fake_response({'data': docs})
+        return fake_response({}, status_code=404)
+    monkeypatch.setattr(transport, 'get', fake_get)
+    result = Dataset.from_ids(['b', 'a', 'c', 'b'], chunk_size=2)
+    assert [d.id if d else None for d in result] == ['b', 'a', None, 'b']
+    assert list(result.errors) == ['c'] and isinstance(result.errors['c'], ValueError)
+    assert len(urls) == 3
+
+def test_collection_stream_pages_and_independent_iterators(monkeypatch):
+    from Skydipper.transport import transport
+    requested = []
+    def fake_get(url, params=None, **kwargs):
+        requested.append(params['page[number]'])
+        start = (params['page[number]'] - 1) * params['page[size]']
+        docs = [{'id': str(i), 'type': 'metadata'} for i in range(start, min(start + params['page[size]'], 25))]
+        return fake_response({'data': docs})
+    monkeypatch.setattr(transport, 'get', fake_get)
+    col = Collection(metadata=[{'id': 'a'}, {'id': 'b'}])
+    assert [(x['id'], y['id']) for x in col for y in col] == [('a', 'a'), ('a', 'b'), ('b', 'a'), ('b', 'b')]
+    assert [item['id'] for item in col.stream(page_size=10)] == [str(i) for i in range(25)]
+    assert requested == [1, 2, 3]
+    col.limit = 12
+    assert len(list(col.stream(page_size=10, prefetch=0))) == 12
+    requested.clear()
+    lazy = Collection(limit=5)
+    assert requested == []
+    assert [item['id'] for item in lazy] == ['0', '1', '2', '3', '4'] and lazy._metadata is None
+    assert requested == [1]
+    # len(), indexing and slices use the same limited, paged results as iteration
+    limited = Collection(limit=12)
+    assert len(limited) == 12
+    assert [item['id'] for item in limited.metadata] == [str(i) for i in range(12)]
+    with pytest.raises(ValueError):
+        Collection(limit=0).metadata
+
+def test_collection_hydrate_in_parallel(monkeypatch):
+    import time
+    from Skydipper import collection
+    def slow_create_class(item):
+        time.sleep(0.2)
+        if item['id'] == 'bad':
+            raise ValueError('Dataset with id=bad does not exist.')
+        return (item['id'], item['server'])
+    monkeypatch.setattr(collection, 'create_class', slow_create_class)
+    col = Collection(metadata=[{'id': str(i)} for i in range(10)] + [{'id': 'bad'}], server='https://example.com')
+    start = time.monotonic()
+    entities = col.hydrate(workers=11)
+    assert time.monotonic() - start < 1
+    assert entities[:10] == [(str(i), 'https://example.com') for i in range(10)] and entities[10] is None
+    assert list(entities.errors) == [10]
+    assert col[8:] == [('8', 'https://example.com'), ('9', 'https://example.com'), None]
+    assert list(col[8:].errors) == [10]
+
+#----- Backup Tests -----#
+
+def test_backup_resumes_from_checkpoint(tmp_path, monkeypatch):
+    from Skydipper.backup import Backup
+    fetched = []
+    def fake_fetch(self, ds_id):
+        fetched.append(ds_id)
+        if ds_id == 'bad':
+            raise ValueError('Could not retrieve config of bad: 500.')
+        return {'id': ds_id, 'type': 'dataset', 'server': self.server, 'attributes': {'name': ds_id}}
+    monkeypatch.setattr(Backup, 'fetch', fake_fetch)
+    assert Backup(path=str(tmp_path)).run(['a', 'b', 'a', 'bad']) == ['bad']
+    assert sorted(fetched) == ['a', 'b', 'bad']
+    assert Backup(path=str(tmp_path)).run(['a', 'b', 'bad', 'c']) == ['bad']
+    assert sorted(fetched[3:]) == ['bad', 'c']
+    assert sorted(os.listdir(tmp_path)) == ['.checkpoint', 'a.json', 'b.json', 'c.json']
+
+def test_default_backup_destinations_resume(tmp_path, monkeypatch):
+    from Skydipper.backup import Backup
+    fetched = []
+    def fake_fetch(self, ds_id):
+        fetched.append(ds_id)
+        return {'id': ds_id, 'type': 'dataset', 'server': self.server, 'attributes': {'name': ds_id}}
+    monkeypatch.setattr(Backup, 'fetch', fake_fetch)
+    monkeypatch.chdir(tmp_path)
+    for format in ['files', 'archive']:
+        fetched.clear()
+        first = Backup(format=format)
+        first.run(['a', 'b'])
+        second = Backup(format=format)
+        assert second.path == first.path and second.run(['a', 'b', 'c']) == []
+        assert sorted(fetched) == ['a', 'b', 'c']
+
+def test_blob_store_snapshots_are_deduplicated(tmp_path, monkeypatch):
+    from Skydipper.backup import Backup, BlobStore, read_record
+    names = {'a': 'first', 'b': 'second'}
+    def fake_fetch(self, ds_id):
+        return {'id': ds_id, 'type': 'dataset', 'server': self.server, 'attributes': {'name': names[ds_id]}}
+    monkeypatch.setattr(Backup, 'fetch', fake_fetch)
+    root = str(tmp_path / 'store')
+    Backup(path=root, format='store', snapshot='2020-05-01@10h-00m').run(['a', 'b'])
+    names['b'] = 'changed'
+    Backup(path=root, format='store', snapshot='2020-05-02@10h-00m').run(['a', 'b'])
+    store = BlobStore(root)
+    first, second = store.read_snapshot('2020-05-01'), store.read_snapshot()
+    assert first['entries']['a'] == second['entries']['a'] and first['entries']['b'] != second['entries']['b']
+    assert sum(len(files) for _, _, files in os.walk(f'{root}/blobs')) == 3
+    assert read_record(root, 'b', snapshot='2020-05-01')['attributes']['name'] == 'second'
+    assert read_record(root, 'b')['attributes']['name'] == 'changed'
+
+def test_store_backup_default_snapshot_resumes_and_merges(tmp_path, monkeypatch):
+    from Skydipper.backup import Backup, BlobStore
+    fetched = []
+    def fake_fetch(self, ds_id):
+        fetched.append(ds_id)
+        return {'id': ds_id, 'type': 'dataset', 'server': self.server, 'attributes': {'name': ds_id}}
+    monkeypatch.setattr(Backup, 'fetch', fake_fetch)
+    root = str(tmp_path / 'store')
+    Backup(path=root, format='store').run(['a', 'b'])
+    Backup(path=root, format='store').run(['a', 'b', 'c'])
+    assert sorted(fetched) == ['a', 'b', 'c']
+    Dataset.from_payload({'id': 'd', 'attributes': {'name': 'd'}}).save(path=root, format='store', snapshot='9999-01-01')
+    store = BlobStore(root)
+    assert store.snapshots()[-1] == '9999-01-01'
+    assert sorted(store.read_snapshot()['entries']) == ['a', 'b', 'c', 'd']
+
+def test_archive_backup_random_access_and_resume(tmp_path, monkeypatch):
+    from Skydipper.backup import Backup, Archive, read_record
+    def fake_fetch(self, ds_id):
+        return {'id': ds_id, 'type': 'dataset', 'server': self.server, 'attributes': {'name': f'dataset {ds_id}'}}
+    monkeypatch.setattr(Backup, 'fetch', fake_fetch)
+    path = str(tmp_path / 'backup.jsonl.gz')
+    Backup(path=path, format='archive').run([str(i) for i in range(50)])
+    # An interrupted write leaves a partial record, dropped when the backup resumes
+    with open(path, 'ab') as f:
+        f.write(b'\x1f\x8b partial')
+    backup = Backup(path=path, format='archive')
+    assert backup.run([str(i) for i in range(60)]) == [] and backup.stats['skipped'] == 50
+    assert read_record(path, '42')['attributes']['name'] == 'dataset 42'
+    assert sorted(int(r['id']) for r in Archive(path)) == list(range(60))
+
+def test_sync_diffs_backup_against_live(tmp_path, monkeypatch):
+    import copy
+    from Skydipper import backup, sync
+    live = {
+        'a': {'name': 'a', 'layer': [{'id': 'l1', 'attributes': {'name': 'l1', 'layerConfig': {'body': {'opacity': 1}, 'type': 'tile'}}}]},
+        'b': {'name': 'b', 'description': 'old'},
+        'c': {'name': 'c', 'description': 'old', 'slug': 'c', 'widget': [{'id': 'w1', 'attributes': {'name': 'w1', 'widgetConfig': {'width': 1}}}],
+              'vocabulary': [{'id': 'knowledge_graph', 'attributes': {'tags': ['a']}}]},
+    }
+    def fake_fetch(ds_id, server="https://api.skydipper.com", user=None):
+        return {'id': ds_id, 'type': 'dataset', 'server': server, 'attributes': copy.deepcopy(live[ds_id])}
+    monkeypatch.setattr(backup, 'fetch_record', fake_fetch)
+    monkeypatch.setattr(sync, 'fetch_record', fake_fetch)
+    root = str(tmp_path / 'store')
+    backup.Backup(path=root, format='store').run(['a', 'b', 'c'])
+    live['a']['layer'][0]['attributes']['layerConfig']['body']['opacity'] = 0.5
+    live['c']['widget'][0]['attributes']['widgetConfig']['width'] = 2
+    live['c']['vocabulary'][0]['attributes']['tags'] = ['b']
+    live['c']['widget'].append({'id': 'w2', 'attributes': {'name': 'w2'}})
+    live['c'].update({'description': 'new', 'slug': 'c-2', 'dataLastUpdated': 'now'})
+    live['a']['layer'][0]['attributes'].update({'slug': 'l1-2', 'dataset': 'x'})
+    result = sync.Sync(root).run()
+    assert result.unchanged == ['b']
+    assert result.changes['a']['layers'] == {'l1': {'layerConfig.body.opacity': [1, 0.5], 'slug': [None, 'l1-2'], 'dataset': [None, 'x']}}
+    assert result.changes['c']['dataset'] == {'description': ['old', 'new'], 'slug': ['c', 'c-2'], 'dataLastUpdated': [None, 'now']}
+    assert result.changes['c']['widgets'] == {'w1': {'widgetConfig.width': [1, 2]}}
+    assert result.changes['c']['vocabulary'] == {'knowledge_graph': {'tags': [['a'], ['b']]}}
+    assert result.changes['c']['only_live'] == {'widget': ['w2']}
+    # Attributes maintained by the server (slug, dataLastUpdated, a layer's dataset) are never patched
+    assert result.patches('server') == [{'method': 'PATCH', 'url': 'https://api.skydipper.com/v1/dataset/a/layer/l1', 'entity': 'layer',
+                                         'id': 'l1', 'json': {'layerConfig': {'body': {'opacity': 1}, 'type': 'tile'}}},
+                                        {'method': 'PATCH', 'url': 'https://api.skydipper.com/v1/dataset/c', 'entity': 'dataset',
+                                         'id': 'c', 'json': {'description': 'old'}},
+                                        {'method': 'PATCH', 'url': 'https://api.skydipper.com/v1/dataset/c/widget/w1', 'entity': 'widget',
+                                         'id': 'w1', 'json': {'widgetConfig': {'width': 1}}}]
+    with pytest.raises(ValueError):
+        result.patches('backup')
+
+def test_layer_update_sends_minimal_patch(monkeypatch):
+    from Skydipper.transport import transport
+    from Skydipper.user import get_user
+    attributes = {'name': 'a layer', 'dataset': 'ds', 'description': 'same',
+                  'layerConfig': {'body': {'maxzoom': 10, 'layers': [{'id': 1}]}, 'type': 'tile'}}
+    layer = Layer.from_payload({'id': 'l1', 'attributes': attributes})
+    sent = []
+    def fake_patch(url, data=None, **kwargs):
+        sent.append(json.loads(data))
+        return fake_response({'data': {'id': 'l1', 'attributes': {**attributes, **json.loads(data)}}})
+    def no_get(*args, **kwargs):
+        raise AssertionError('unexpected GET')
+    monkeypatch.setattr(transport, 'patch', fake_patch)
+    monkeypatch.setattr(transport, 'get', no_get)
+    monkeypatch.setattr(type(get_user()), 'token', 'a-token')
+    layer.update({'description': 'same', 'layerConfig.body.maxzoom': 10})
+    assert sent == []
+    layer.update({'description': 'same', 'layerConfig.body.maxzoom': 12})
+    assert sent == [{'layerConfig': {'body': {'maxzoom': 12, 'layers': [{'id': 1}]}, 'type': 'tile'}}]
+    assert layer.attributes['layerConfig']['body']['maxzoom'] == 12
+    assert attributes['layerConfig']['body']['maxzoom'] == 10
+
+def test_update_payload_paths_through_lists():
+    from Skydipper.utils import update_payload
+    attributes = {'widgetRelevantProps': ['a', 'b'], 'name': 'x', 'layerConfig': {'body': {'layers': [{'id': 1}]}}}
+    keys = ['widgetRelevantProps', 'name', 'layerConfig']
+    assert update_payload(attributes, {'widgetRelevantProps.0': 'value'}, keys) == {'widgetRelevantProps': ['value', 'b']}
+    assert update_payload(attributes, {'layerConfig.body.layers.0.id': 2}, keys) == {'layerConfig': {'body': {'layers': [{'id': 2}]}}}
+    for bad in [{'widgetRelevantProps.x': 'v'}, {'widgetRelevantProps.5': 'v'}, {'name.first': 'v'}]:
+        with pytest.raises(ValueError):
+            update_payload(attributes, bad, keys)
+    assert attributes['widgetRelevantProps'] == ['a', 'b']
+
+#----- Query Tests -----#
+
+def fake_query_dataset(monkeypatch, n_rows, queries):
+    """A carto Dataset whose query service serves rows 0..n_rows-1 of a table, recording the SQL it receives."""
+    import re
+    from Skydipper.transport import transport
+    def fake_get(url, params=None, **kwargs):
+        sql = params['sql']
+        queries.append(sql)
+        if 'count(' in sql:
+            rows = [{'count': n_rows}]
+        else:
+            limit = re.search(r'limit (\d+)', sql, flags=re.I)
+            offset = re.search(r'offset (\d+)', sql, flags=re.I)
+            start = int(offset.group(1)) if offset else 0
+            stop = min(n_rows, start + int(limit.group(1))) if limit else n_rows
+            rows = [{'cartodb_id': i, 'value': i * 0.5, 'name': f'row {i}'} for i in range(start, stop)]
+        return fake_response({'data': rows})
+    monkeypatch.setattr(transport, 'get', fake_get)
+    return Dataset.from_payload({'id': 'ds', 'attributes': {'name': 'table', 'provider': 'cartodb', 'tableName': 'a_table'}})
+
+def test_dataset_query_iter_pages(monkeypatch):
+    pytest.importorskip('geopandas')
+    queries = []
+    ds = fake_query_dataset(monkeypatch, 25, queries)
+    chunks = list(ds.query_iter('SELECT * FROM data', chunk_size=10))
+    assert [len(c) for c in chunks] == [10, 10, 5]
+    assert list(chunks[2]['cartodb_id']) == [20, 21, 22, 23, 24]
+    assert queries[0] == 'select * FROM a_table ORDER BY cartodb_id LIMIT 10 OFFSET 0'
+    assert [len(c) for c in ds.query_iter('SELECT * FROM data LIMIT 12 OFFSET 3', chunk_size=5, prefetch=0)] == [5, 5, 2]
+    from Skydipper import dataset
+    options = []
+    monkeypatch.setattr(dataset, 'rows_to_frame', lambda rows, **kwargs: options.append(kwargs))
+    list(ds.query_iter('SELECT * FROM data', chunk_size=10, columnar=False))
+    assert options and all(o['columnar'] is False for o in options)
+
+def test_dataset_query_parallel_pages(monkeypatch):
+    pytest.importorskip('geopandas')
+    queries = []
+    ds = fake_query_dataset(monkeypatch, 25, queries)
+    table = ds.query('SELECT * FROM data', parallel=3, chunk_size=10)
+    assert list(table['cartodb_id']) == list(range(25))
+    assert queries[0] == 'SELECT count(*) FROM (select * FROM a_table) AS q'
+    assert sorted(queries[1:]) == [f'select * FROM a_table ORDER BY cartodb_id LIMIT {n} OFFSET {o}' for n, o in [(10, 0), (10, 10), (5, 20)]]
+    queries.clear()
+    ds.query('SELECT * FROM data ORDER BY name DESC LIMIT 10', parallel=2, chunk_size=5)
+    assert queries[1:] and all(q.startswith('select * FROM a_table order by name desc LIMIT 5') for q in queries[1:])
+    with pytest.raises(ValueError):
+        ds.query('SELECT * FROM data', parallel=2, order_by=None)
+    from Skydipper.utils import has_order_by
+    assert not has_order_by('select *, row_number() over (order by x) from (select * from t order by y) q')
+
+def test_query_rows_columnar_dtypes():
+    pa = pytest.importorskip('pyarrow')
+    from Skydipper.utils import rows_to_frame
+    rows = [{'n': 1, 'x': 0.5, 'ok': True, 'name': 'a'}, {'n': None, 'x': 1.5, 'ok': False, 'name': None}]
+    table = rows_to_frame(rows)
+    assert str(table['n'].dtype) == 'Int64' and str(table['ok'].dtype) == 'boolean' and str(table['x'].dtype) == 'float64'
+    assert table['n'].tolist()[0] == 1 and table['n'].isna().tolist() == [False, True]
+    assert str(table['name'].dtype) == 'string' and table['name'].isna().tolist() == [False, True]
+    uneven = rows_to_frame([{'a': 1}, {'a': 2, 'b': 'x'}, {'c': 0.5}])
+    assert list(uneven.columns) == ['a', 'b', 'c'] and uneven['b'].tolist()[1] == 'x'
+    assert uneven['a'].isna().tolist() == [False, False, True]
+    mixed = rows_to_frame([{'v': 1}, {'v': 'a'}])
+    assert mixed['v'].tolist() == [1, 'a']
+    with pytest.raises((pa.ArrowInvalid, pa.ArrowTypeError)):
+        rows_to_frame([{'v': 1}, {'v': 'a'}], columnar=True)
+
+def test_layer_carto_query_csv(monkeypatch):
+    pytest.importorskip('pyarrow')
+    from Skydipper.transport import transport
+    sent = []
+    def fake_get(url, params=None, **kwargs):
+        sent.append((url, params))
+        return fake_response(b'cartodb_id,value,name\n1,0.5,a\n2,,b\n')
+    monkeypatch.setattr(transport, 'get', fake_get)
+    layer = Layer.from_payload({'id': 'l', 'attributes': {'name': 'layer', 'layerConfig': {
+        'account': 'acc', 'body': {'layers': [{'options': {'sql': 'SELECT * FROM a_table'}}]}}}})
+    table = layer.get_carto_query('SELECT cartodb_id, value, name FROM data')
+    assert sent[0] == ('https://acc.carto.com/api/v2/sql', {'q': 'with t as (SELECT * FROM a_table) SELECT cartodb_id, value, name from t', 'format': 'csv'})
+    assert table['cartodb_id'].tolist() == [1, 2] and str(table['value'].dtype) == 'float64'
+
+def test_query_geometry_columns_decoded():
+    shapely = pytest.importorskip('shapely')
+    from Skydipper.utils import rows_to_frame
+    point = shapely.Point(1, 2)
+    rows = [{'the_geom': shapely.to_wkb(shapely.set_srid(point, 4326), hex=True, include_srid=True),
+             'geojson': shapely.to_geojson(point), 'code': '0100ABCDEF12', 'name': 'a'},
+            {'the_geom': None, 'geojson': None, 'code': None, 'name': 'b'}]
+    for columnar in [False, None]:
+        table = rows_to_frame(rows, columnar=columnar)
+        assert table.geometry.name == 'the_geom' and table.crs == 'EPSG:4326'
+        assert table['the_geom'].iloc[0].equals(point) and table['the_geom'].iloc[1] is None
+        assert table['geojson'].iloc[0].equals(point)
+        assert table['code'].iloc[0] == '0100ABCDEF12'
+    text = rows_to_frame([{'g': 'POINT (1 2)'}, {'g': 'Point Reyes'}, {'g': None}])
+    assert text['g'].tolist()[:2] == ['POINT (1 2)', 'Point Reyes']
+    raw = rows_to_frame(rows, decode_geometry=False)
+    assert raw['the_geom'].iloc[0] == rows[0]['the_geom']
+
+def test_dataset_query_cached_parquet(monkeypatch, tmp_path):
+    pytest.importorskip('pyarrow')
+    from Skydipper.cache import QueryCache, read_parquet
+    queries = []
+    ds = fake_query_dataset(monkeypatch, 25, queries)
+    ds.attributes['updatedAt'] = '2020-01-01'
+    cache = QueryCache(path=str(tmp_path / 'cache'))
+    first = ds.query_cached('SELECT * FROM data', cache=cache)
+    again = ds.query_cached('SELECT *  FROM data;', cache=cache)
+    assert len(queries) == 1 and cache.stats == {'hits': 1, 'misses': 1}
+    assert again['cartodb_id'].tolist() == first['cartodb_id'].tolist() == list(range(25))
+    ds.attributes['updatedAt'] = '2020-01-02'
+    ds.query_cached('SELECT * FROM data', cache=cache)
+    assert len(queries) == 2 and len(os.listdir(cache.path)) == 2
+    ds.query_cached('SELECT * FROM data', cache=cache, parallel=2)
+    ds.query_cached('SELECT * FROM data', cache=cache, parallel=2, order_by='name')
+    ds.query_cached('SELECT * FROM data', cache=cache, columnar=False)
+    assert len(os.listdir(cache.path)) == 5 and cache.stats['hits'] == 1
+    del ds.attributes['updatedAt']
+    ds.query_cached('SELECT * FROM data', cache=cache)
+    assert len(os.listdir(cache.path)) == 5 and cache.stats['hits'] == 1
+    cache.max_bytes = 0
+    cache.evict()
+    assert os.listdir(cache.path) == []
+    path = ds.to_parquet(str(tmp_path / 'table.parquet'), 'SELECT * FROM data LIMIT 3')
+    assert read_parquet(path)['name'].tolist() == ['row 0', 'row 1', 'row 2']
+
+def test_query_cache_geoparquet_and_age(tmp_path):
+    pytest.importorskip('pyarrow')
+    shapely = pytest.importorskip('shapely')
+    from Skydipper.cache import QueryCache
+    from Skydipper.utils import rows_to_frame
+    cache = QueryCache(path=str(tmp_path), max_age=60)
+    table = rows_to_frame([{'the_geom': shapely.to_wkb(shapely.Point(1, 2), hex=True), 'v': 1}])
+    cache.put('k', table)
+    cached = cache.get('k')
+    assert cached.geometry.name == 'the_geom' and cached.crs == 'EPSG:4326'
+    assert cached['the_geom'].iloc[0].equals(shapely.Point(1, 2))
+    os.utime(cache.file('k'), (0, 0))
+    assert cache.get('k') is None
+    import pyarrow as pa
+    from Skydipper.cache import write_parquet
+    with pytest.raises(pa.ArrowException):
+        write_parquet(rows_to_frame([{'v': 1}, {'v': 'a'}], columnar=False).assign(v=[object(), object()]), str(tmp_path / 'bad.parquet'))
+    assert sorted(os.listdir(tmp_path)) == ['k.parquet']